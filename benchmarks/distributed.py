@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+""" Crawl the mock site with several distributed nodes sharing one delta
+collection, and check that they finish it.
+
+    python -m benchmarks.distributed [--nodes 3] [--kill-after 5 [--kill-node 2]]
+
+Every node is a `scrapy crawl food` process of its own, with
+DELTA_DISTRIBUTED and its own NODE_ID and NODE_INDEX, against a local
+mongod. Leases last `--lease-ttl` seconds and are extended every
+`--heartbeat` seconds. With `--kill-after`, a node, the last one by
+default, is killed that many seconds into the crawl, so the others have to
+reclaim its leases once they expire. Entries are leased by the node which
+found them, so kill a node which has seeds of its own: with CITY_IDS of
+`benchmarks.settings`, the last node of 2 or 3 has one.
+
+The same site is crawled by a single node first, into a database of its
+own. Exits with an error if a node fails, if an entry of the shared delta
+collection is left unfinished, or if the nodes stored other shops than
+the single node.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import pymongo
+from .mock_site import MockSite, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_node(name, env, workdir, settings):
+    node_dir = os.path.join(workdir, name)
+    os.makedirs(node_dir)
+    env = dict(env,
+               BENCH_ARCHIVE_DIR=os.path.join(node_dir, 'archive'),
+               BENCH_SNAPSHOT_PATH=os.path.join(node_dir, 'profile.json'))
+    cmd = [sys.executable, '-m', 'scrapy', 'crawl', 'food',
+           # a snapshot of the seen filter per node would be of the shared
+           # collection, but only of the entries finished by that node
+           '-s', 'DELTA_SEEN_FILTER_PATH=']
+    for setting in settings:
+        cmd += ['-s', setting]
+    log = open(os.path.join(node_dir, 'crawl.log'), 'w')
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def node_stats(workdir, name):
+    path = os.path.join(workdir, name, 'profile.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['stats']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--kill-after', type=float, default=0,
+                        help='seconds before a node is killed, 0 kills none')
+    parser.add_argument('--kill-node', type=int, default=-1, help='index of the node to kill')
+    parser.add_argument('--lease-ttl', type=int, default=10)
+    parser.add_argument('--heartbeat', type=float, default=2)
+    parser.add_argument('--mongo-uri', default='mongodb://127.0.0.1:27017')
+    parser.add_argument('--database', default='dianping_bench_distributed')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per page')
+    parser.add_argument('--pages', type=int, default=3)
+    parser.add_argument('--shops', type=int, default=300)
+    parser.add_argument('--timeout', type=float, default=600)
+    args = parser.parse_args()
+
+    server = serve(MockSite(pages=args.pages, shops=args.shops), latency=args.latency)
+    host = 'http://{}:{}'.format(*server.server_address)
+    client = pymongo.MongoClient(args.mongo_uri)
+    single_database = args.database + '_single'
+    for database in (args.database, single_database):
+        client.drop_database(database)
+    env = dict(os.environ,
+               SCRAPY_SETTINGS_MODULE='benchmarks.settings',
+               BENCH_HOST=host,
+               BENCH_MONGO_URI=args.mongo_uri)
+    settings = ['LISTING_PAGE_LIMIT={}'.format(args.pages)]
+    workdir = tempfile.mkdtemp(prefix='bench_distributed_')
+
+    failed = False
+    try:
+        start = time.time()
+        single = start_node('single', dict(env, BENCH_MONGO_DATABASE=single_database),
+                            workdir, settings)
+        if single.wait(args.timeout) != 0:
+            print('FAILED single node, see {}'.format(os.path.join(workdir, 'single')))
+            sys.exit(1)
+        single_elapsed = time.time() - start
+
+        env['BENCH_MONGO_DATABASE'] = args.database
+        names = ['node-{}'.format(i) for i in range(args.nodes)]
+        start = time.time()
+        nodes = [start_node(name, env, workdir, settings + [
+            'DELTA_DISTRIBUTED=1',
+            'NODE_ID={}'.format(name),
+            'NODE_INDEX={}'.format(i),
+            'NODE_COUNT={}'.format(args.nodes),
+            'DELTA_LEASE_TTL={}'.format(args.lease_ttl),
+            'DELTA_HEARTBEAT_INTERVAL={}'.format(args.heartbeat),
+        ]) for i, name in enumerate(names)]
+
+        killed = None
+        if args.kill_after:
+            victim = nodes[args.kill_node]
+            try:
+                victim.wait(args.kill_after)
+            except subprocess.TimeoutExpired:
+                victim.kill()
+                killed = names[args.kill_node]
+        for name, node in zip(names, nodes):
+            try:
+                node.wait(max(args.timeout - (time.time() - start), 1))
+            except subprocess.TimeoutExpired:
+                node.kill()
+                node.wait()
+                failed = True
+                print('TIMEOUT {}'.format(name))
+            if node.returncode != 0 and name != killed:
+                failed = True
+                print('FAILED {}, exit code {}'.format(name, node.returncode))
+        elapsed = time.time() - start
+    finally:
+        server.shutdown()
+
+    print('{:<10}{:>10}{:>10}'.format('node', 'pages', 'items'))
+    for name in ['single'] + names:
+        stats = node_stats(workdir, name)
+        print('{:<10}{:>10}{:>10}{}'.format(
+            name, stats.get('response_received_count', '-'), stats.get('item_scraped_count', '-'),
+            '  killed' if name == killed else ''))
+    print('single node {:.1f}s, {} nodes {:.1f}s'.format(single_elapsed, args.nodes, elapsed))
+
+    db = client[args.database]
+    unfinished = db['delta'].count_documents({'finished': False})
+    if unfinished:
+        failed = True
+        print('UNFINISHED {} entries of the delta collection'.format(unfinished))
+    shops = set(doc['_id'] for doc in db['food'].find({}, {'_id': 1}))
+    expected = set(doc['_id'] for doc in client[single_database]['food'].find({}, {'_id': 1}))
+    print('{} shops, {} by the single node'.format(len(shops), len(expected)))
+    if shops != expected:
+        failed = True
+        print('MISMATCH {} shops missing, {} unexpected'.format(
+            len(expected - shops), len(shops - expected)))
+
+    if failed:
+        print('logs in {}'.format(workdir))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
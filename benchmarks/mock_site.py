@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+""" Local HTTP server replaying Dianping fixture pages.
+
+    python -m benchmarks.mock_site --port 8787
+
+Pages are rendered from `fixtures/` and are deterministic: shop ids of a
+listing only depend on its path, and different listings overlap like the
+real site does, so the delta frontier has duplicates to drop.
+
+Listings of a category, an area or both have different sizes, some are
+empty, and like the real site at most `pages` pages of a listing are shown.
+Areas have sub-areas, which replace the area in urls like on the real site,
+e.g. g110r2580 -> g110r1400.
+
+Servers also accept requests of absolute urls, so they can be used as fake
+HTTP proxies, with latency and bans to test `ProxyPoolMiddleware`, and
+can redirect sessions to verification pages to test `SessionPoolMiddleware`.
+"""
+import os
+import re
+import json
+import time
+import zlib
+import argparse
+import threading
+from string import Template
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+TAGS = ['回头客', '干净卫生', '体验好', '服务热情', '味道赞']
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return Template(f.read())
+
+
+class MockSite(object):
+    """ Size of the site:
+
+    - `categories` x `areas` x `subareas` listings per city, of up to
+      `pages` pages of `shops_per_page` shops each, shop ids are drawn from
+      `shops` ids per city. Listings of an area are made of its sub-areas,
+      so they may be larger
+    - `review_pages` pages of `reviews_per_page` reviews per shop
+    """
+    CITY_RE = re.compile(r'^/search/category/(\d+)/10/?$')
+    LISTING_RE = re.compile(r'^/search/category/(\d+)/10/((?:g\d+)?(?:r\d+)?)(?:p(\d+))?$')
+    SHOP_RE = re.compile(r'^/shop/(\d+)$')
+    REVIEW_ALL_RE = re.compile(r'^/shop/(\d+)/review_all$')
+
+    def __init__(self, categories=4, areas=4, subareas=3, pages=3, shops_per_page=15,
+                 shops=300, review_pages=3, reviews_per_page=20, tags=3):
+        self.categories = categories
+        self.areas = areas
+        self.subareas = subareas
+        self.pages = pages
+        self.shops_per_page = shops_per_page
+        self.shops = shops
+        self.review_pages = review_pages
+        self.reviews_per_page = reviews_per_page
+        self.tags = tags
+        self.templates = {name: load_fixture(name) for name in os.listdir(FIXTURES_DIR)}
+        self.hits = 0
+
+    def render(self, name, **kwargs):
+        return self.templates[name].substitute(**kwargs)
+
+    # return (status, content type, body)
+    def handle(self, url):
+        self.hits += 1
+        parsed = urlparse(url)
+        path, query = parsed.path, parse_qs(parsed.query)
+        handlers = [
+            (self.CITY_RE, self.city_index),
+            (self.LISTING_RE, self.listing),
+            (self.SHOP_RE, self.shop_detail),
+            (self.REVIEW_ALL_RE, self.review_all),
+        ]
+        for regex, handler in handlers:
+            m = regex.match(path)
+            if m:
+                return handler(query, *m.groups())
+        if path == '/ajax/json/shopDynamic/allReview':
+            return self.all_review(query)
+        if path == '/ajax/json/shopfood/wizard/getReviewListFPAjax':
+            return self.tagged_reviews(query)
+        return 404, 'text/html', '<html><body>not found</body></html>'
+
+    LINK_FMT = '    <a href="/search/category/{}/10/{}">{}</a>'
+    REGION_RE = re.compile(r'^(g\d+)?(r\d+)?$')
+
+    def category_ids(self):
+        return ['g{}'.format(110 + i) for i in range(self.categories)]
+
+    def area_ids(self):
+        return ['r{}'.format(2580 + i) for i in range(self.areas)]
+
+    # r2580 -> r1400, r1401, ...
+    def subarea_ids(self, area):
+        i = int(area[1:]) - 2580
+        return ['r{}'.format(1400 + i * 10 + k) for k in range(self.subareas)]
+
+    # area of a sub-area, None for an area
+    def parent_area(self, area):
+        if area in self.area_ids():
+            return None
+        return 'r{}'.format(2580 + (int(area[1:]) - 1400) // 10)
+
+    # sub-areas of an area, or the sub-area itself
+    def leaf_areas(self, area):
+        if self.parent_area(area) is None:
+            return self.subarea_ids(area)
+        return [area]
+
+    # shop ids of a category in a sub-area, a quarter of them is empty
+    def region_shops(self, city_id, category, subarea):
+        seed = zlib.crc32('{}/{}{}'.format(city_id, category, subarea).encode('utf-8'))
+        size = 0 if seed % 4 == 0 else seed % (self.pages * self.shops_per_page) + 1
+        base = int(city_id) * 10000000
+        return [base + (seed + i) % self.shops for i in range(size)]
+
+    # shops of all regions of the listing
+    def listing_shops(self, city_id, category=None, area=None):
+        categories = [category] if category else self.category_ids()
+        areas = [area] if area else self.area_ids()
+        return [shop_id for c in categories for a in areas for leaf in self.leaf_areas(a)
+                for shop_id in self.region_shops(city_id, c, leaf)]
+
+    def city_index(self, _query, city_id):
+        link = self.LINK_FMT
+        classfies = [link.format(city_id, c, c) for c in self.category_ids()]
+        areas = [link.format(city_id, a, a) for a in self.area_ids()]
+        body = self.render('city_index.html', city_id=city_id,
+                           classfies='\n'.join(classfies), areas='\n'.join(areas),
+                           count=len(self.listing_shops(city_id)))
+        return 200, 'text/html', body
+
+    def listing(self, _query, city_id, region, page):
+        page = int(page or 1)
+        category, area = self.REGION_RE.match(region).groups()
+        shop_ids = self.listing_shops(city_id, category, area)
+        count = len(shop_ids)
+        start = (page - 1) * self.shops_per_page
+        shops = [self.render('listing_shop.html', shop_id=shop_id)
+                 for shop_id in shop_ids[start:start + self.shops_per_page]]
+        next = ''
+        if page * self.shops_per_page < count and page < self.pages:
+            next = '<a class="next" href="/search/category/{}/10/{}p{}">下一页</a>'.format(
+                city_id, region, page + 1)
+
+        # refinements of a category by areas, of an area by categories and
+        # sub-areas, and siblings of a sub-area, along with itself
+        link = self.LINK_FMT
+        classfies = []
+        if area and not category:
+            classfies = [link.format(city_id, c + area, c) for c in self.category_ids()]
+        if not area:
+            area_ids = self.area_ids()
+        elif self.parent_area(area) is None:
+            area_ids = self.subarea_ids(area)
+        else:
+            area_ids = self.subarea_ids(self.parent_area(area))
+        areas = [link.format(city_id, (category or '') + a, a) for a in area_ids]
+        body = self.render('listing.html', shops='\n'.join(shops), next=next, count=count,
+                           classfies='\n'.join(classfies), areas='\n'.join(areas))
+        return 200, 'text/html', body
+
+    def shop_detail(self, _query, shop_id):
+        star = int(shop_id) % 6 * 10
+        return 200, 'text/html', self.render('shop_detail.html', shop_id=shop_id, star=star)
+
+    def review_all(self, query, shop_id):
+        page = int(query.get('pageno', ['1'])[0])
+        reviews = []
+        # newest first, like the real site
+        newest = int(shop_id) * 1000 + self.review_pages * self.reviews_per_page - 1
+        for i in range(self.reviews_per_page):
+            review_id = newest - (page - 1) * self.reviews_per_page - i
+            reviews.append(self.render('review_all_item.html', review_id=review_id,
+                                       user_id=review_id % 100000, star=review_id % 6 * 10))
+        next = ''
+        if page < self.review_pages:
+            next = '<a class="NextPage" href="?pageno={}">下一页</a>'.format(page + 1)
+        body = self.render('review_all.html', shop_id=shop_id, page=page,
+                           reviews='\n'.join(reviews), next=next)
+        return 200, 'text/html', body
+
+    def all_review(self, _query):
+        summarys = [{'summaryName': tag, 'summaryCount': i + 1}
+                    for i, tag in enumerate(TAGS[:self.tags])]
+        body = self.render('all_review.json', summarys=json.dumps(summarys, ensure_ascii=False))
+        return 200, 'application/json', body
+
+    def tagged_reviews(self, query):
+        shop_id = int(query.get('shopId', ['0'])[0])
+        # tagged reviews are a subset of all reviews
+        items = []
+        newest = shop_id * 1000 + self.review_pages * self.reviews_per_page - 1
+        for i in range(0, self.reviews_per_page, 2):
+            review_id = newest - i
+            items.append(self.render('tagged_review_item.html', review_id=review_id,
+                                     user_id=review_id % 100000, star=review_id % 6 * 10))
+        msg = '<ul>{}</ul>'.format('\n'.join(items))
+        return 200, 'application/json', json.dumps({'code': 200, 'msg': msg}, ensure_ascii=False)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# every `ban_every` request is answered with 403, after `latency` seconds,
+# and requests of cookies containing `challenge` are redirected to a
+# verification page
+def make_handler(site, latency=0, ban_every=0, challenge=None):
+    counter = {'requests': 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                counter['requests'] += 1
+                banned = ban_every and counter['requests'] % ban_every == 0
+            if latency:
+                time.sleep(latency)
+            if challenge and challenge in self.headers.get('Cookie', ''):
+                self.send_response(302)
+                self.send_header('Location', 'https://verify.meituan.com/v2/web/general_page')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if banned:
+                status, content_type, body = 403, 'text/html', '<html><body>banned</body></html>'
+            else:
+                status, content_type, body = site.handle(self.path)
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', '{}; charset=utf-8'.format(content_type))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+# return the server, which is serving in a daemon thread
+def serve(site, host='127.0.0.1', port=0, latency=0, ban_every=0, challenge=None):
+    server = ThreadingHTTPServer((host, port), make_handler(site, latency, ban_every, challenge))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(MockSite()))
+    print('serving on http://{}:{}'.format(args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
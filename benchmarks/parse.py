@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+""" Compare the PyQuery and lxml parser engines on fixture pages.
+
+    python -m benchmarks.parse [--rounds 50]
+
+Exits with an error if the engines extract different results, or reviews
+differ from those of pages demojized as a whole, and reports CPU
+milliseconds per page of both.
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import emoji
+from pyquery import PyQuery as pq
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+from dianping_crawler.spiders import extractors
+from dianping_crawler.spiders.food import FoodSpider
+from dianping_crawler.spiders.review import ReviewSpider
+from .mock_site import MockSite
+
+EMPTY_PAGE = '<html><head></head><body><div class="main"></div></body></html>'
+
+
+def make_response(url, body):
+    request = Request('http://127.0.0.1' + url)
+    return HtmlResponse(url=request.url, body=body.encode('utf-8'), encoding='utf-8',
+                        request=request)
+
+
+def load_pages(site, count):
+    shop_ids = [20000000 + i for i in range(count)]
+    pages = {'detail': [], 'review_all': [], 'tagged_reviews': []}
+    for shop_id in shop_ids:
+        pages['detail'].append(site.handle('/shop/{}'.format(shop_id))[2])
+        pages['review_all'].append(site.handle('/shop/{}/review_all'.format(shop_id))[2])
+        body = site.handle('/ajax/json/shopfood/wizard/getReviewListFPAjax?shopId={}'.format(shop_id))[2]
+        pages['tagged_reviews'].append(json.loads(body)['msg'])
+    pages['detail'].append(EMPTY_PAGE)
+    pages['review_all'].append(EMPTY_PAGE)
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pages', type=int, default=20, help='pages of each kind')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+    # empty pages warn on every field
+    logging.basicConfig(level=logging.ERROR)
+
+    food = FoodSpider.from_crawler(get_crawler(FoodSpider))
+    review = ReviewSpider.from_crawler(get_crawler(ReviewSpider))
+    pages = load_pages(MockSite(), args.pages)
+
+    engines = {
+        'detail': {
+            'pyquery': lambda body: food.extract_shop(make_response('/shop/1', body)),
+            'lxml': extractors.extract_shop,
+        },
+        'review_all': {
+            'pyquery': lambda body: review.do_parse_reviews(pq(body)),
+            'lxml': lambda body: extractors.extract_review_page(body)['reviews'],
+        },
+        'tagged_reviews': {
+            'pyquery': lambda body: review.do_parse_tagged_reviews(pq(body), 'tag'),
+            'lxml': lambda body: extractors.extract_tagged_reviews(body, 'tag'),
+        },
+    }
+
+    # reviews used to be extracted from pages demojized as a whole
+    references = {
+        'review_all': lambda body: extractors.extract_review_page(
+            emoji.demojize(body), normalize=False)['reviews'],
+        'tagged_reviews': lambda body: extractors.extract_tagged_reviews(
+            emoji.demojize(body), 'tag', normalize=False),
+    }
+
+    failed = False
+    print('{:<16}{:>16}{:>16}{:>10}'.format('page', 'pyquery ms/page', 'lxml ms/page', 'speedup'))
+    for kind, funcs in engines.items():
+        for body in pages[kind]:
+            expected, actual = funcs['pyquery'](body), funcs['lxml'](body)
+            if expected != actual:
+                failed = True
+                print('MISMATCH {}:\n  pyquery: {}\n  lxml:    {}'.format(kind, expected, actual))
+            if kind in references and references[kind](body) != actual:
+                failed = True
+                print('MISMATCH {} with pages demojized as a whole'.format(kind))
+
+        cpu = {}
+        for engine, func in funcs.items():
+            start = time.process_time()
+            for _ in range(args.rounds):
+                for body in pages[kind]:
+                    func(body)
+            cpu[engine] = (time.process_time() - start) * 1000 / (args.rounds * len(pages[kind]))
+        print('{:<16}{:>16.3f}{:>16.3f}{:>9.1f}x'.format(
+            kind, cpu['pyquery'], cpu['lxml'], cpu['pyquery'] / cpu['lxml']))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+""" Measure how parsing scales with the worker processes of `PARSER_PROCESSES`.
+
+    python -m benchmarks.parse_pool [--processes 1 2 4 8]
+
+Pages of every callback offloaded by `ParseOffloadMiddleware` are parsed
+by the same worker entry points, inline and in process pools of each
+size, and pages/sec is reported with the speedup over inline parsing.
+"""
+import os
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dianping_crawler.spiders import extractors
+from .mock_site import MockSite
+
+
+def load_pages(site, count):
+    pages = []
+    for i in range(count):
+        shop_id = 20000000 + i
+        pages.append(('detail', site.handle('/shop/{}'.format(shop_id))[2], {}))
+        pages.append(('parse_review_all',
+                      site.handle('/shop/{}/review_all'.format(shop_id))[2], {}))
+        url = '/ajax/json/shopfood/wizard/getReviewListFPAjax?shopId={}'.format(shop_id)
+        pages.append(('parse_tagged_reviews', site.handle(url)[2], {'tag': 'tag'}))
+    return [(name, body.encode('utf-8'), meta) for name, body, meta in pages]
+
+
+def parse(page):
+    name, body, meta = page
+    return extractors.WORKER_PARSERS[name](body, 'utf-8', meta, True)
+
+
+def run_inline(pages, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        for page in pages:
+            parse(page)
+    return len(pages) * rounds / (time.time() - start)
+
+
+def run_pool(pages, rounds, processes):
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # start workers before timing
+        list(executor.map(parse, pages[:processes]))
+        start = time.time()
+        # submitted one by one like the middleware does
+        futures = [executor.submit(parse, page) for _ in range(rounds) for page in pages]
+        for future in futures:
+            future.result()
+        return len(futures) / (time.time() - start)
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    default = sorted({1, 2, 4, cpus} & set(range(1, cpus + 1)))
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pages', type=int, default=20, help='shops to render pages of')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--processes', type=int, nargs='+', default=default)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    pages = load_pages(MockSite(), args.pages)
+    inline = run_inline(pages, args.rounds)
+    print('{:<12}{:>14}{:>10}'.format('processes', 'pages/sec', 'speedup'))
+    print('{:<12}{:>14.1f}{:>9.1f}x'.format('inline', inline, 1))
+    for processes in args.processes:
+        rate = run_pool(pages, args.rounds, processes)
+        print('{:<12}{:>14.1f}{:>9.1f}x'.format(processes, rate, rate / inline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+""" Measure how throughput scales with healthy proxies of ProxyPoolMiddleware.
+
+    python -m benchmarks.proxy_pool [--proxies 1 2 4] [--bad 1]
+
+Every run crawls shop detail pages of the real host name through fake
+proxies, which are mock sites of `--latency`, plus `--bad` proxies that
+ban every request. Each run is a scrapy process of its own, and reports
+pages/sec and stats of the pool.
+"""
+import sys
+import json
+import time
+import argparse
+import subprocess
+import scrapy
+from scrapy.crawler import CrawlerProcess
+from .mock_site import MockSite, serve
+
+STATS = ['proxy_pool/banned', 'proxy_pool/retry', 'proxy_pool/quarantined',
+         'proxy_pool/evicted', 'proxy_pool/healthy']
+
+
+class ShopsSpider(scrapy.Spider):
+    name = 'proxy_bench'
+
+    def __init__(self, pages=100, **kwargs):
+        super().__init__(**kwargs)
+        # never resolved, proxies receive the absolute url
+        self.start_urls = ['http://www.dianping.com/shop/{}'.format(20000000 + i)
+                           for i in range(int(pages))]
+
+    def parse(self, response):
+        self.crawler.stats.inc_value('bench/pages')
+
+
+def run(args):
+    site = MockSite()
+    servers = [serve(site, latency=args.latency) for _ in range(args.run)]
+    servers += [serve(site, latency=args.latency, ban_every=1) for _ in range(args.bad)]
+    proxies = ['http://{}:{}'.format(*server.server_address) for server in servers]
+
+    process = CrawlerProcess({
+        'LOG_LEVEL': 'WARNING',
+        'ROBOTSTXT_OBEY': False,
+        'CONCURRENT_REQUESTS': 2,
+        'DOWNLOADER_MIDDLEWARES': {'dianping_crawler.middlewares.ProxyPoolMiddleware': 740},
+        'PROXY_POOL_ENABLED': True,
+        'PROXIES': proxies,
+        'PROXY_CONCURRENCY': args.concurrency,
+        'PROXY_DOWNLOAD_DELAY': args.delay,
+        'PROXY_QUARANTINE': 1,
+        'PROXY_MAX_QUARANTINES': 2,
+    })
+    crawler = process.create_crawler(ShopsSpider)
+    start = time.time()
+    process.crawl(crawler, pages=args.pages)
+    process.start()
+    elapsed = time.time() - start
+
+    stats = crawler.stats.get_stats()
+    result = {k: stats.get(k, 0) for k in STATS}
+    result['pages'] = stats.get('bench/pages', 0)
+    result['pages_per_sec'] = result['pages'] / elapsed
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--proxies', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--bad', type=int, default=1, help='proxies banning every request')
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--delay', type=float, default=0.1)
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run(args)
+        return
+
+    print('{:<10}{:>8}{:>12}{:>10}{:>8}{:>14}{:>10}'.format(
+        'proxies', 'pages', 'pages/sec', 'banned', 'retry', 'quarantined', 'evicted'))
+    for n in args.proxies:
+        cmd = [sys.executable, '-m', 'benchmarks.proxy_pool', '--run', str(n)]
+        for name in ('bad', 'pages', 'latency', 'concurrency', 'delay'):
+            cmd += ['--' + name, str(getattr(args, name))]
+        result = json.loads(subprocess.check_output(cmd).decode('utf-8').splitlines()[-1])
+        print('{:<10}{:>8}{:>12.1f}{:>10}{:>8}{:>14}{:>10}'.format(
+            n, result['pages'], result['pages_per_sec'], result['proxy_pool/banned'],
+            result['proxy_pool/retry'], result['proxy_pool/quarantined'],
+            result['proxy_pool/evicted']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+""" Replay full crawls against the local mock site and a local mongod.
+
+    python -m benchmarks.run --output benchmarks/results/after.json \\
+                             --baseline benchmarks/results/before.json
+
+Every spider runs in its own `scrapy crawl` process, after dropping the
+benchmark database. Reported per spider:
+
+- pages/sec and items/sec, over the crawl time of the profile snapshot
+- CPU seconds per page, of the whole scrapy process
+- mongodb ops per item
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import pymongo
+from .mock_site import MockSite, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRICS = ['pages_per_sec', 'items_per_sec', 'cpu_per_page', 'mongo_ops_per_item']
+
+
+def count_items(db, spider):
+    if spider == 'review' and 'reviews' in db.list_collection_names():
+        # normalized layout, a review of n tags counts n + 1 times like the
+        # embedded layout does
+        pipeline = [{'$group': {'_id': None, 'n': {'$sum': {'$add': [
+            1, {'$size': {'$ifNull': ['$tags', []]}},
+        ]}}}}]
+        result = list(db['reviews'].aggregate(pipeline))
+        return result[0]['n'] if result else 0
+    if spider == 'review':
+        # reviews are written into shop documents by the spider
+        pipeline = [{'$project': {'n': {'$add': [
+            {'$size': {'$ifNull': ['$reviews', []]}},
+            {'$size': {'$ifNull': ['$tagged_reviews', []]}},
+        ]}}}, {'$group': {'_id': None, 'n': {'$sum': '$n'}}}]
+        result = list(db['review'].aggregate(pipeline))
+        return result[0]['n'] if result else 0
+    return db[spider].count_documents({})
+
+
+def run_spider(spider, env, db, extra_settings):
+    snapshot_path = os.path.join(ROOT, 'bench_profile_{}.json'.format(spider))
+    env = dict(env, BENCH_SNAPSHOT_PATH=snapshot_path)
+    cmd = [sys.executable, '-m', 'scrapy', 'crawl', spider]
+    for setting in extra_settings:
+        cmd += ['-s', setting]
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    subprocess.check_call(cmd, cwd=ROOT, env=env)
+    wall = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+
+    with open(snapshot_path) as f:
+        snapshot = json.load(f)
+    stats = snapshot['stats']
+    elapsed = snapshot['elapsed_seconds'] or wall
+    pages = stats.get('response_received_count', 0)
+    items = count_items(db, spider)
+    mongo_ops = sum(v for k, v in stats.items()
+                    if k.startswith('mongodb/ops/') and k.endswith('/count'))
+
+    return {
+        'pages': pages,
+        'items': items,
+        'elapsed': elapsed,
+        'cpu': cpu,
+        'mongo_ops': mongo_ops,
+        'pages_per_sec': pages / elapsed if elapsed else 0,
+        'items_per_sec': items / elapsed if elapsed else 0,
+        'cpu_per_page': cpu / pages if pages else 0,
+        'mongo_ops_per_item': mongo_ops / items if items else 0,
+    }
+
+
+def print_report(report, baseline=None):
+    print('{:<10}{:<22}{:>14}{:>14}{:>10}'.format('spider', 'metric', 'value', 'baseline', 'change'))
+    for spider, result in report['spiders'].items():
+        for metric in METRICS:
+            value = result[metric]
+            base = (baseline or {}).get('spiders', {}).get(spider, {}).get(metric)
+            if base:
+                change = '{:+.1%}'.format((value - base) / base)
+                base = '{:.4f}'.format(base)
+            else:
+                change = base = '-'
+            print('{:<10}{:<22}{:>14.4f}{:>14}{:>10}'.format(spider, metric, value, base, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--spiders', nargs='+', default=['food', 'review'])
+    parser.add_argument('--mongo-uri', default='mongodb://127.0.0.1:27017')
+    parser.add_argument('--database', default='dianping_bench')
+    parser.add_argument('--output', help='write the report as JSON')
+    parser.add_argument('--baseline', help='report to compare with')
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra scrapy setting, e.g. -s STORAGE_BACKEND=sync')
+    parser.add_argument('--categories', type=int, default=4)
+    parser.add_argument('--areas', type=int, default=4)
+    parser.add_argument('--subareas', type=int, default=3)
+    parser.add_argument('--pages', type=int, default=3)
+    parser.add_argument('--shops', type=int, default=300)
+    parser.add_argument('--review-pages', type=int, default=3)
+    args = parser.parse_args()
+
+    site = MockSite(categories=args.categories, areas=args.areas, subareas=args.subareas,
+                    pages=args.pages, shops=args.shops, review_pages=args.review_pages)
+    server = serve(site)
+    host = 'http://{}:{}'.format(*server.server_address)
+
+    client = pymongo.MongoClient(args.mongo_uri)
+    client.drop_database(args.database)
+    db = client[args.database]
+    env = dict(os.environ,
+               SCRAPY_SETTINGS_MODULE='benchmarks.settings',
+               BENCH_HOST=host,
+               BENCH_MONGO_URI=args.mongo_uri,
+               BENCH_MONGO_DATABASE=args.database)
+
+    report = {'time': time.time(), 'settings': args.set, 'spiders': {}}
+    try:
+        # review spider crawls the shops saved by food spider
+        for spider in args.spiders:
+            settings = ['LISTING_PAGE_LIMIT={}'.format(args.pages)] + args.set
+            report['spiders'][spider] = run_spider(spider, env, db, settings)
+    finally:
+        server.shutdown()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
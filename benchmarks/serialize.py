@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+""" Round trip requests through the delta serialization, and time it.
+
+    python -m benchmarks.serialize [--rounds 20000]
+
+Requests of every callback of both spiders go through
+`DeltaHelper.request_serialize`, BSON and `DeltaHelper.request_deserialize`,
+with errbacks, priorities, non-default headers, contexts and every field
+of `META_FIELDS`. Exits with an error if a rebuilt request differs, or if
+scrapy internals of meta or default headers are stored. Reports
+microseconds per request of every step, and bytes per entry.
+"""
+import sys
+import time
+import argparse
+import bson
+import scrapy
+from scrapy.http import Headers
+from scrapy.utils.test import get_crawler
+from dianping_crawler.context import CrawlContext
+from dianping_crawler.spiders.delta_helper import DeltaHelper
+from dianping_crawler.spiders.food import FoodSpider
+from dianping_crawler.spiders.review import ReviewSpider
+
+DEFAULT_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en',
+}
+# set by scrapy, never stored
+INTERNAL_META = {'depth': 3, 'download_slot': 'www.dianping.com', 'download_latency': 0.2,
+                 'download_timeout': 180.0, 'retry_times': 1}
+
+
+def make_requests(food, review):
+    host = 'http://www.dianping.com'
+    context = CrawlContext(2, 'beijing', 20000005)
+    requests = [
+        scrapy.Request(host + '/search/category/2/10', food.parse, priority=100,
+                       meta={'context': CrawlContext(2, 'beijing')}),
+        scrapy.Request(host + '/search/category/2/10/g110r2580p2', food.index, priority=50,
+                       meta={'context': CrawlContext(2, 'beijing')}),
+        scrapy.Request(host + '/shop/20000005', food.detail,
+                       meta={'context': CrawlContext(2, 'beijing', '20000005')}),
+        # non-default headers and an errback
+        scrapy.Request(host + '/ajax/json/shopDynamic/allReview?shopId=20000005', review.parse,
+                       errback=review.parse_tagged_reviews, priority=-10,
+                       headers={'Referer': host + '/shop/20000005', 'X-Requested-With': 'XMLHttpRequest',
+                                'Accept-Language': 'zh-CN'},
+                       meta={'context': context, 'shop_url': host + '/shop/20000005'}),
+        scrapy.Request(host + '/shop/20000005/review_all', review.parse_review_all, priority=75,
+                       meta={'context': context, 'tags': ['回头客', '干净卫生'],
+                             'newest_review_id': 333523022, 'max_review_id': 333523099}),
+        scrapy.Request(host + '/ajax/json/shopfood/wizard/getReviewListFPAjax?shopId=20000005',
+                       review.parse_tagged_reviews,
+                       meta={'context': context, 'tag': '回头客', 'newest_review_id': 333523022}),
+        # no callback, no meta
+        scrapy.Request(host + '/robots.txt'),
+    ]
+    headers = Headers(DEFAULT_HEADERS)
+    for request in requests:
+        # like DefaultHeadersMiddleware does
+        for k, v in headers.items():
+            request.headers.setdefault(k, v)
+        request.meta.update(INTERNAL_META)
+    return requests
+
+
+def spider_meta(meta):
+    return {k: v for k, v in meta.items() if k not in INTERNAL_META}
+
+
+def check(spider, request, default_headers):
+    serialized = DeltaHelper.request_serialize(request, default_headers)
+    errors = []
+    for k in INTERNAL_META:
+        if k in serialized['meta']:
+            errors.append('meta {} is stored'.format(k))
+    for k in (serialized.get('headers') or {}):
+        if default_headers.getlist(k) == request.headers.getlist(k):
+            errors.append('default header {} is stored'.format(k))
+
+    stored = bson.BSON(bson.BSON.encode(serialized)).decode()
+    rebuilt = DeltaHelper.request_deserialize(spider, stored)
+    # rebuilt by DefaultHeadersMiddleware, like a resumed request would be
+    for k, v in default_headers.items():
+        rebuilt.headers.setdefault(k, v)
+
+    for field in ('url', 'method', 'callback', 'errback', 'priority'):
+        if getattr(rebuilt, field) != getattr(request, field):
+            errors.append('{}: {!r} != {!r}'.format(
+                field, getattr(rebuilt, field), getattr(request, field)))
+    if rebuilt.headers.to_unicode_dict() != request.headers.to_unicode_dict():
+        errors.append('headers: {} != {}'.format(rebuilt.headers.to_unicode_dict(),
+                                                 request.headers.to_unicode_dict()))
+    if rebuilt.meta != spider_meta(request.meta):
+        errors.append('meta: {} != {}'.format(rebuilt.meta, spider_meta(request.meta)))
+    if stored['_id'] != DeltaHelper.request_fingerprint(request.method, request.url):
+        errors.append('_id is not the fingerprint')
+    return errors
+
+
+def timed(func, cases, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for case in cases:
+            func(*case)
+    return (time.perf_counter() - start) * 1e6 / (rounds * len(cases))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=20000)
+    args = parser.parse_args()
+
+    food = FoodSpider.from_crawler(get_crawler(FoodSpider))
+    review = ReviewSpider.from_crawler(get_crawler(ReviewSpider))
+    default_headers = Headers(DEFAULT_HEADERS)
+    # (spider of the callback, request)
+    cases = [(getattr(r.callback, '__self__', food), r) for r in make_requests(food, review)]
+
+    failed = False
+    covered = set()
+    for spider, request in cases:
+        for error in check(spider, request, default_headers):
+            failed = True
+            print('MISMATCH {}: {}'.format(request.url, error))
+        covered.update(DeltaHelper.request_serialize(request)['meta'])
+    missing = set(DeltaHelper.META_FIELDS) - covered
+    if missing:
+        failed = True
+        print('NOT COVERED {}'.format(', '.join(sorted(missing))))
+
+    serialized = [(spider, DeltaHelper.request_serialize(r, default_headers)) for spider, r in cases]
+    encoded = [(spider, bson.BSON.encode(s)) for spider, s in serialized]
+    steps = [
+        ('request_serialize', lambda _, r: DeltaHelper.request_serialize(r, default_headers), cases),
+        ('bson encode', lambda _, s: bson.BSON.encode(s), serialized),
+        ('bson decode', lambda _, e: bson.BSON(e).decode(), encoded),
+        ('request_deserialize', DeltaHelper.request_deserialize, serialized),
+    ]
+    print('{:<24}{:>12}'.format('step', 'us/request'))
+    for name, func, inputs in steps:
+        print('{:<24}{:>12.2f}'.format(name, timed(func, inputs, args.rounds)))
+    print('{:<24}{:>12.1f}'.format('bytes/entry', sum(len(e) for _, e in encoded) / len(encoded)))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
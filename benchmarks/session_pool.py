@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+""" Measure how throughput scales with healthy sessions of SessionPoolMiddleware.
+
+    python -m benchmarks.session_pool [--sessions 1 2 4] [--bad 1]
+
+Every run crawls shop detail pages of the mock site with a sessions file
+of `--sessions` jars, plus `--bad` jars which are redirected to the
+verification page. Each session is a slot of `--concurrency` and
+`--delay`. Each run is a scrapy process of its own, and reports pages/sec
+and stats of the pool.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import scrapy
+from scrapy.crawler import CrawlerProcess
+from .mock_site import MockSite, serve
+
+STATS = ['session_pool/requests', 'session_pool/banned', 'session_pool/retired',
+         'session_pool/active', 'ban/verify']
+CHALLENGE = 'challenge=1'
+
+
+class ShopsSpider(scrapy.Spider):
+    name = 'session_bench'
+
+    def __init__(self, host, pages=100, **kwargs):
+        super().__init__(**kwargs)
+        self.start_urls = ['{}/shop/{}'.format(host, 20000000 + i) for i in range(int(pages))]
+
+    def parse(self, response):
+        self.crawler.stats.inc_value('bench/pages')
+
+
+def run(args):
+    server = serve(MockSite(), latency=args.latency, challenge=CHALLENGE)
+    host = 'http://{}:{}'.format(*server.server_address)
+    jars = ['_hc.v=session-{}'.format(i) for i in range(args.run)]
+    jars += ['_hc.v=bad-{}; {}'.format(i, CHALLENGE) for i in range(args.bad)]
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write('\n'.join(jars))
+
+    process = CrawlerProcess({
+        'LOG_LEVEL': 'WARNING',
+        'ROBOTSTXT_OBEY': False,
+        'COOKIES_ENABLED': False,
+        'CONCURRENT_REQUESTS': 1,
+        'DOWNLOADER_MIDDLEWARES': {
+            'dianping_crawler.middlewares.SessionPoolMiddleware': 745,
+            'dianping_crawler.middlewares.BanDetectionMiddleware': 650,
+        },
+        'SESSION_POOL_ENABLED': True,
+        'SESSIONS_FILE': f.name,
+        'SESSION_CONCURRENCY': args.concurrency,
+        'SESSION_DOWNLOAD_DELAY': args.delay,
+        'BAN_DETECTION_ENABLED': True,
+    })
+    crawler = process.create_crawler(ShopsSpider)
+    start = time.time()
+    process.crawl(crawler, host=host, pages=args.pages)
+    process.start()
+    elapsed = time.time() - start
+    os.remove(f.name)
+
+    stats = crawler.stats.get_stats()
+    result = {k: stats.get(k, 0) for k in STATS}
+    result['pages'] = stats.get('bench/pages', 0)
+    result['pages_per_sec'] = result['pages'] / elapsed
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--bad', type=int, default=1, help='sessions challenged on every request')
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--delay', type=float, default=0.2)
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run(args)
+        return
+
+    print('{:<10}{:>8}{:>12}{:>10}{:>10}{:>8}'.format(
+        'sessions', 'pages', 'pages/sec', 'requests', 'retired', 'active'))
+    for n in args.sessions:
+        cmd = [sys.executable, '-m', 'benchmarks.session_pool', '--run', str(n)]
+        for name in ('bad', 'pages', 'latency', 'concurrency', 'delay'):
+            cmd += ['--' + name, str(getattr(args, name))]
+        result = json.loads(subprocess.check_output(cmd).decode('utf-8').splitlines()[-1])
+        print('{:<10}{:>8}{:>12.1f}{:>10}{:>10}{:>8}'.format(
+            n, result['pages'], result['pages_per_sec'], result['session_pool/requests'],
+            result['session_pool/retired'], result['session_pool/active']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+# Settings of benchmark runs against the local mock site, see `run.py`
+import os
+from dianping_crawler.settings import *  # noqa: F401,F403
+
+HOST = os.environ.get('BENCH_HOST', 'http://127.0.0.1:8787')
+MONGO_URI = os.environ.get('BENCH_MONGO_URI', 'mongodb://127.0.0.1:27017')
+MONGO_DATABASE = os.environ.get('BENCH_MONGO_DATABASE', 'dianping_bench')
+
+CITY_IDS = [
+    (2, 'beijing'),
+    (1, 'shanghai'),
+]
+
+CONCURRENT_REQUESTS = 16
+CONCURRENT_REQUESTS_PER_DOMAIN = 16
+DOWNLOAD_DELAY = 0
+SESSION_CONCURRENCY = 16
+SESSION_DOWNLOAD_DELAY = 0
+LOG_LEVEL = 'INFO'
+
+# fixture pages are small
+BAN_MIN_BODY_SIZE = 0
+
+ARCHIVE_DIR = os.environ.get('BENCH_ARCHIVE_DIR', 'bench_archive')
+# the database is dropped before every run, so the snapshot is rebuilt
+DELTA_SEEN_FILTER_PATH = 'bench_delta_seen.bloom'
+
+PROFILE_ENABLED = True
+PROFILE_SNAPSHOT_PATH = os.environ.get('BENCH_SNAPSHOT_PATH', 'bench_profile.json')
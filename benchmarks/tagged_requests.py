@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+""" Check that generating tagged review requests costs the same however
+many shops the `review` collection holds.
+
+    python -m benchmarks.tagged_requests [--sizes 1000 10000 100000]
+
+For every size, the collection is seeded with that many shop documents of
+`--tags` tags each, in a database of its own on a local mongod, and
+`ReviewSpider.gen_tagged_review_requests` is timed for shops spread over
+the collection:
+
+- meta:     tags carried in request meta, no query at all
+- fallback: tags of requests resumed from an older delta collection, one
+            `_id` point query
+- scan:     the former implementation, which read every document of the
+            collection, for reference
+
+Exits with an error if a request of a shop is generated for tags of
+another shop, or if the cost of meta or fallback grows more than
+`--max-growth` times from the smallest size to the largest one.
+"""
+import os
+import sys
+import time
+import argparse
+import pymongo
+from scrapy.utils.test import get_crawler
+from dianping_crawler.context import CrawlContext
+from dianping_crawler.spiders.review import ReviewSpider
+from .mock_site import TAGS
+
+MONGO_URI = os.environ.get('BENCH_MONGO_URI', 'mongodb://127.0.0.1:27017')
+DATABASE = 'dianping_bench_tagged'
+
+
+def seed(collection, size, tags):
+    collection.drop()
+    chunk = []
+    for i in range(size):
+        shop_tags = [[TAGS[(i + j) % len(TAGS)] + str(i), 10 + j] for j in range(tags)]
+        chunk.append({'_id': 20000000 + i, 'tags': shop_tags, 'reviews': [], 'tagged_reviews': []})
+        if len(chunk) >= 1000:
+            collection.insert_many(chunk)
+            chunk = []
+    if chunk:
+        collection.insert_many(chunk)
+
+
+# what gen_tagged_review_requests did before, tags of every shop
+def scan(collection):
+    return [tag for item in collection.find() for tag, _ in item['tags']]
+
+
+def timed(func, shop_ids, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for shop_id in shop_ids:
+            func(shop_id)
+    return (time.perf_counter() - start) * 1000 / (rounds * len(shop_ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--tags', type=int, default=3, help='tags per shop')
+    parser.add_argument('--shops', type=int, default=100, help='shops timed per size')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--max-growth', type=float, default=3)
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(MONGO_URI)
+    collection = client[DATABASE]['review']
+    spider = ReviewSpider.from_crawler(get_crawler(ReviewSpider, {'HOST': 'http://127.0.0.1'}))
+    spider.db_collection = collection
+
+    def generate(shop_id, tags=None):
+        return list(spider.gen_tagged_review_requests(CrawlContext(2, 'beijing', shop_id), tags))
+
+    failed = False
+    results = []
+    print('{:>10}{:>16}{:>16}{:>16}'.format('shops', 'meta ms', 'fallback ms', 'scan ms'))
+    for size in args.sizes:
+        seed(collection, size, args.tags)
+        step = max(size // args.shops, 1)
+        shop_ids = [20000000 + i for i in range(0, size, step)][:args.shops]
+        tags = {doc['_id']: [tag for tag, _ in doc['tags']]
+                for doc in collection.find({'_id': {'$in': shop_ids}})}
+
+        for shop_id in shop_ids:
+            requests = generate(shop_id)
+            if [r.meta['tag'] for r in requests] != tags[shop_id] or \
+                    any(r.meta['context'].shop_id != shop_id for r in requests):
+                failed = True
+                print('MISMATCH tagged requests of shop {}'.format(shop_id))
+
+        result = {
+            'meta': timed(lambda shop_id: generate(shop_id, tags[shop_id]), shop_ids, args.rounds),
+            'fallback': timed(generate, shop_ids, args.rounds),
+            # a single round of a few shops, it reads the whole collection
+            'scan': timed(lambda shop_id: scan(collection), shop_ids[:3], 1),
+        }
+        results.append(result)
+        print('{:>10}{:>16.3f}{:>16.3f}{:>16.3f}'.format(
+            size, result['meta'], result['fallback'], result['scan']))
+
+    for key in ('meta', 'fallback'):
+        growth = results[-1][key] / results[0][key]
+        if growth > args.max_growth:
+            failed = True
+            print('REGRESSION {} grows {:.1f}x from {} to {} shops'.format(
+                key, growth, args.sizes[0], args.sizes[-1]))
+
+    client.drop_database(DATABASE)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# Archive of raw responses in append-only segment files
+#
+# Every record is keyed by the delta fingerprint of its request, and holds
+# the compressed response with what callbacks need to run again:
+#
+#   MAGIC | fingerprint (16) | codec (1) | len(info) (4) | len(body) (4)
+#   | info | body
+#
+# `info` is JSON of url, status, headers, callback and meta of the request.
+# Segments are named by creation time, so later records of a fingerprint
+# win when the archive is replayed.
+import os
+import json
+import time
+import zlib
+import struct
+import logging
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DPA1'
+HEADER = struct.Struct('>16sBII')
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODECS = {'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+
+def compressor(codec, level):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress
+    return lambda data: zlib.compress(data, level)
+
+
+def decompress(codec, data):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read zstd records')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class SegmentWriter(object):
+    """ Append records to segment files of `directory`, a new segment is
+    started when the current one has `segment_size` bytes.
+
+    'zstd' falls back to 'zlib' if zstandard is not installed.
+    """
+
+    def __init__(self, directory, segment_size=256 * 1024 * 1024, codec='zstd', level=3):
+        if codec == 'zstd' and zstandard is None:
+            logger.warning('zstandard is not installed, archive with zlib')
+            codec = 'zlib'
+        if codec not in CODECS:
+            raise ValueError('unknown archive codec: {}'.format(codec))
+        self.directory = directory
+        self.segment_size = segment_size
+        self.codec = CODECS[codec]
+        self.compress = compressor(self.codec, level)
+        self.file = None
+        self.sequence = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def open_segment(self):
+        self.close()
+        self.sequence += 1
+        name = 'segment-{}-{}-{:04d}.dat'.format(
+            time.strftime('%Y%m%d%H%M%S'), os.getpid(), self.sequence)
+        self.file = open(os.path.join(self.directory, name), 'ab')
+
+    # return bytes written
+    def write(self, fingerprint, info, body):
+        if self.file is None or self.file.tell() >= self.segment_size:
+            self.open_segment()
+        info = self.compress(json.dumps(info).encode('utf-8'))
+        body = self.compress(body)
+        record = b''.join([MAGIC, HEADER.pack(fingerprint, self.codec, len(info), len(body)),
+                           info, body])
+        self.file.write(record)
+        return len(record)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def segment_paths(directory):
+    names = sorted(n for n in os.listdir(directory) if n.startswith('segment-'))
+    return [os.path.join(directory, n) for n in names]
+
+
+# yield (fingerprint, offset) of records of a segment, without reading the
+# records themselves
+def scan_segment(path):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            offset = f.tell()
+            head = f.read(len(MAGIC) + HEADER.size)
+            if not head:
+                return
+            if len(head) < len(MAGIC) + HEADER.size or not head.startswith(MAGIC):
+                logger.warning('truncated record at %s:%d', path, offset)
+                return
+            fingerprint, _, info_size, body_size = HEADER.unpack(head[len(MAGIC):])
+            # cut by a crash while writing, it would hide an older record
+            if offset + len(MAGIC) + HEADER.size + info_size + body_size > size:
+                logger.warning('truncated record at %s:%d', path, offset)
+                return
+            f.seek(info_size + body_size, os.SEEK_CUR)
+            yield fingerprint, offset
+
+
+# {fingerprint: (path, offset)} of the latest records, of fingerprints in
+# shard `index` of `count`
+def index_archive(directory, index=0, count=1):
+    records = {}
+    for path in segment_paths(directory):
+        for fingerprint, offset in scan_segment(path):
+            if int.from_bytes(fingerprint[:4], 'big') % count == index:
+                records[fingerprint] = (path, offset)
+    return records
+
+
+def read_header(f, offset):
+    f.seek(offset)
+    head = f.read(len(MAGIC) + HEADER.size)
+    return HEADER.unpack(head[len(MAGIC):])
+
+
+# info of the record at `offset` of an opened segment, without its body
+def read_record_info(f, offset):
+    _, codec, info_size, _ = read_header(f, offset)
+    return json.loads(decompress(codec, f.read(info_size)).decode('utf-8'))
+
+
+# return (info, body) of the record at `offset` of an opened segment
+def read_record(f, offset):
+    _, codec, info_size, body_size = read_header(f, offset)
+    info = json.loads(decompress(codec, f.read(info_size)).decode('utf-8'))
+    body = decompress(codec, f.read(body_size))
+    return info, body
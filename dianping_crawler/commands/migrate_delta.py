@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import bson
+import pymongo
+from pymongo.errors import BulkWriteError
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from ..spiders.delta_helper import DeltaHelper
+
+
+class Command(ScrapyCommand):
+    """ Rewrite the delta collection with compact fingerprints and lean
+    documents, and report index size and write volume before and after.
+    """
+    requires_project = True
+    CHUNK_SIZE = 1000
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Migrate the delta collection to compact fingerprints'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument('--collection', default='delta',
+                            help='delta collection name (default: %(default)s)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='write the compact collection, but keep the old one in use')
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        settings = self.settings
+        client = pymongo.MongoClient(settings.get('MONGO_URI'))
+        db = client[settings.get('MONGO_DATABASE', 'delta')]
+        name = opts.collection
+        tmp_name = '{}_compact'.format(name)
+        old, new = db[name], db[tmp_name]
+        new.drop()
+
+        # size of the update sent by `mark_as_finished`
+        finished_update_size = len(bson.BSON.encode({'$set': {'finished': True}}))
+        old_write_bytes = new_write_bytes = count = 0
+        chunk = []
+
+        # the epoch marker is not migrated, the compact collection gets its own
+        cond = {'_id': {'$ne': DeltaHelper.EPOCH_ID}}
+        for doc in old.find(cond).batch_size(self.CHUNK_SIZE):
+            old_write_bytes += len(bson.BSON.encode({'$set': doc}))
+            # old entries stored the default headers as Binary, drop them
+            doc.pop('headers', None)
+            compacted = DeltaHelper.compact_serialized(doc)
+            new_write_bytes += finished_update_size
+            count += 1
+            chunk.append(compacted)
+            if len(chunk) >= self.CHUNK_SIZE:
+                self.insert_chunk(new, chunk)
+                chunk = []
+        self.insert_chunk(new, chunk)
+        new.create_index(DeltaHelper.RESUME_INDEX)
+
+        before = db.command('collStats', name)
+        after = db.command('collStats', tmp_name)
+        print('migrated {} entries'.format(count))
+        print('{:<28}{:>16}{:>16}'.format('', 'before', 'after'))
+        for key in ('avgObjSize', 'size', 'storageSize', 'totalIndexSize'):
+            print('{:<28}{:>16}{:>16}'.format(key, before.get(key, 0), after.get(key, 0)))
+        print('{:<28}{:>16}{:>16}'.format('mark_as_finished bytes', old_write_bytes, new_write_bytes))
+
+        if opts.dry_run:
+            print('dry run, compact collection is kept as "{}"'.format(tmp_name))
+            return
+
+        backup_name = '{}_backup_{}'.format(name, int(time.time()))
+        old.rename(backup_name)
+        new.rename(name)
+        print('old collection is renamed to "{}"'.format(backup_name))
+
+        # the snapshot is keyed by the old ids
+        seen_path = settings.get('DELTA_SEEN_FILTER_PATH')
+        if seen_path and os.path.exists(seen_path):
+            os.remove(seen_path)
+            print('removed outdated snapshot "{}"'.format(seen_path))
+
+    def insert_chunk(self, collection, chunk):
+        if not chunk:
+            return
+        try:
+            collection.insert_many(chunk, ordered=False)
+        except BulkWriteError as e:
+            # several old ids of the same request
+            errors = [err for err in e.details['writeErrors'] if err['code'] != 11000]
+            if errors:
+                raise
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import subprocess
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+
+class Command(ScrapyCommand):
+    """ Run callbacks of a spider over the latest archived response of
+    every request in `ARCHIVE_DIR`, see `ArchiveMiddleware`. Nothing is
+    downloaded, and items go through the pipelines as usual, except that
+    `BufferedMongoPipeline` leaves the recrawl schedule of stored items
+    alone, see `write_replayed_items`.
+
+    With `--processes N`, the archive is split into N shards by
+    fingerprint, and every shard is replayed by its own process.
+    """
+    requires_project = True
+
+    def syntax(self):
+        return '[options] <spider>'
+
+    def short_desc(self):
+        return 'Re-extract items from archived responses'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument('--archive', metavar='DIR',
+                            help='archive directory (default: ARCHIVE_DIR)')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='replay shards in this many processes (default: %(default)s)')
+        parser.add_argument('--shard', metavar='I/N',
+                            help='only replay shard I of N')
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        settings = self.settings
+        if opts.archive:
+            settings.set('ARCHIVE_DIR', opts.archive, priority='cmdline')
+        if opts.shard:
+            try:
+                index, count = map(int, opts.shard.split('/'))
+            except ValueError:
+                raise UsageError('invalid shard: {}'.format(opts.shard))
+            if not 0 <= index < count:
+                raise UsageError('invalid shard: {}'.format(opts.shard))
+            settings.set('REPLAY_SHARD_INDEX', index, priority='cmdline')
+            settings.set('REPLAY_SHARD_COUNT', count, priority='cmdline')
+        settings.set('REPLAY_ENABLED', True, priority='cmdline')
+        settings.set('ARCHIVE_ENABLED', False, priority='cmdline')
+        settings.set('DELTA_READ_ONLY', True, priority='cmdline')
+        # responses are read from disk, nothing to be polite to
+        settings.set('DOWNLOAD_DELAY', 0, priority='cmdline')
+        settings.set('CONCURRENT_REQUESTS', 100, priority='cmdline')
+        settings.set('CONCURRENT_REQUESTS_PER_DOMAIN', 100, priority='cmdline')
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        if not os.path.isdir(self.settings.get('ARCHIVE_DIR', 'archive')):
+            raise UsageError('no archive in {}'.format(self.settings.get('ARCHIVE_DIR')))
+        spider_name = args[0]
+
+        if opts.processes > 1 and not opts.shard:
+            self.run_shards(spider_name, opts)
+            return
+
+        self.crawler_process.crawl(spider_name)
+        self.crawler_process.start()
+
+    # one subprocess per shard, with the same options
+    def run_shards(self, spider_name, opts):
+        workers = []
+        for i in range(opts.processes):
+            cmd = [sys.executable, '-m', 'scrapy.cmdline', 'reparse', spider_name,
+                   '--archive', self.settings.get('ARCHIVE_DIR'),
+                   '--shard', '{}/{}'.format(i, opts.processes)]
+            for setting in opts.set:
+                cmd.extend(['-s', setting])
+            if opts.logfile:
+                cmd.extend(['--logfile', '{}.{}'.format(opts.logfile, i)])
+            workers.append(subprocess.Popen(cmd))
+
+        codes = [worker.wait() for worker in workers]
+        failed = [i for i, code in enumerate(codes) if code != 0]
+        if failed:
+            print('shards failed: {}'.format(', '.join(map(str, failed))))
+            self.exitcode = 1
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+
+class CrawlContext(object):
+    """ Fields of a crawl carried from responses to child requests as
+    `request.meta['context']`, instead of copying the whole response meta
+    with scrapy internals such as `depth` and `download_slot`.
+
+    Contexts are not modified once created, so children of a page share
+    the context of the page, and `replace` returns a new one.
+    """
+    __slots__ = ('city_id', 'city_name', 'shop_id')
+
+    def __init__(self, city_id=None, city_name=None, shop_id=None):
+        self.city_id = city_id
+        self.city_name = city_name
+        self.shop_id = shop_id
+
+    def replace(self, **kwargs):
+        fields = self.to_dict()
+        fields.update(kwargs)
+        return type(self)(**fields)
+
+    # fields which are set
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__ if getattr(self, k) is not None}
+
+    # context of fields of `d`, or None if it has none of them
+    @classmethod
+    def from_dict(cls, d):
+        fields = {k: d[k] for k in cls.__slots__ if d.get(k) is not None}
+        return cls(**fields) if fields else None
+
+    def __eq__(self, other):
+        return isinstance(other, CrawlContext) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'CrawlContext({})'.format(', '.join(
+            '{}={!r}'.format(k, v) for k, v in sorted(self.to_dict().items())))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+# Define here your extensions
+#
+# See documentation in:
+# http://doc.scrapy.org/en/latest/topics/extensions.html
+import os
+import json
+import time
+import signal
+import bisect
+import logging
+import threading
+from collections import defaultdict
+from pymongo import monitoring
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """ Count calls and latencies of every mongodb command.
+
+    Commands may run in storage threads, so they are collected here and
+    merged into stats by `CrawlProfiler`.
+    """
+    # upper bounds of latency histogram, in milliseconds
+    BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(float)
+        self.enabled = True
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event, 'mongodb/ops/{}/'.format(event.command_name))
+
+    def failed(self, event):
+        self.record(event, 'mongodb/failed/{}/'.format(event.command_name))
+
+    def record(self, event, prefix):
+        if not self.enabled:
+            return
+        ms = event.duration_micros / 1000
+        i = bisect.bisect_left(self.BUCKETS, ms)
+        bucket = 'le_{}ms'.format(self.BUCKETS[i]) if i < len(self.BUCKETS) else 'inf'
+        with self.lock:
+            self.values[prefix + 'count'] += 1
+            self.values[prefix + 'seconds'] += ms / 1000
+            self.values[prefix + 'latency/' + bucket] += 1
+
+    def pop_values(self):
+        with self.lock:
+            values, self.values = self.values, defaultdict(float)
+        return values
+
+
+class StackSampler(object):
+    """ Sampling profiler driven by SIGPROF, counts collapsed stacks which
+    can be rendered by flamegraph.pl.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = defaultdict(int)
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def sample(self, _signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}'.format(code.co_filename, code.co_name))
+            frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write('{} {}\n'.format(stack, count))
+
+
+class CrawlProfiler(object):
+    """ Cheap enough to keep on in production, it records:
+
+    - per-callback wall and CPU time, by `ProfilingSpiderMiddleware`
+    - `parse` time, building the PyQuery document only, and `extract`
+      time, the whole lxml extraction with demojize, by `BaseSpider.timed`;
+      neither is recorded for pages parsed by `ParseOffloadMiddleware`
+    - response bytes per callback
+    - per-operation mongodb call counts and latency histograms
+
+    into stats, and writes them to `PROFILE_SNAPSHOT_PATH` as JSON every
+    `PROFILE_SNAPSHOT_INTERVAL` seconds. With `PROFILE_SAMPLING_INTERVAL`
+    set, a sampling profiler writes collapsed stacks to
+    `PROFILE_SAMPLING_PATH` on spider closed.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.snapshot_path = settings.get('PROFILE_SNAPSHOT_PATH')
+        self.snapshot_interval = settings.getfloat('PROFILE_SNAPSHOT_INTERVAL', 60)
+        self.snapshot_task = None
+        self.sampling_path = settings.get('PROFILE_SAMPLING_PATH', 'profile.stacks')
+        interval = settings.getfloat('PROFILE_SAMPLING_INTERVAL', 0)
+        self.sampler = StackSampler(interval) if interval > 0 else None
+
+        # only applies to clients created later, i.e. in spiders and pipelines
+        self.listener = MongoCommandListener()
+        monitoring.register(self.listener)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PROFILE_ENABLED'):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        return ext
+
+    def spider_opened(self, spider):
+        self.start_time = time.time()
+        if self.snapshot_path:
+            self.snapshot_task = task.LoopingCall(self.snapshot, spider)
+            self.snapshot_task.start(self.snapshot_interval, now=False)
+        if self.sampler:
+            self.sampler.start()
+
+    def spider_closed(self, spider):
+        if self.snapshot_task and self.snapshot_task.running:
+            self.snapshot_task.stop()
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler.dump(self.sampling_path)
+        self.snapshot(spider)
+        self.listener.enabled = False
+
+    def response_received(self, response, request, spider):
+        name = getattr(request.callback, '__name__', 'parse')
+        self.stats.inc_value('profile/callback/{}/bytes'.format(name), len(response.body))
+
+    def merge_mongo_stats(self):
+        for k, v in self.listener.pop_values().items():
+            self.stats.inc_value(k, v)
+
+    def snapshot(self, spider):
+        self.merge_mongo_stats()
+        if not self.snapshot_path:
+            return
+        stats = self.stats.get_stats()
+        snapshot = {
+            'spider': spider.name,
+            'time': time.time(),
+            'elapsed_seconds': time.time() - self.start_time,
+            'stats': {k: v for k, v in stats.items() if isinstance(v, (int, float))},
+        }
+        tmp_path = self.snapshot_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f, indent=2, sort_keys=True)
+            # readers never see a half written file
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            self.logger.error('write profile snapshot failed: %s', e)
@@ -4,11 +4,162 @@
 #
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/items.html
+#
+# Items are classes of `__slots__`, which take less memory than dicts while
+# they are buffered for bulk writes, and are turned into documents by
+# `to_bson`. `validate` catches bad extractions before they reach mongodb,
+# see `ITEM_VALIDATION`. `SlotsItemAdapter` lets scrapy, e.g. feed exports,
+# read them through `ItemAdapter`.
+from datetime import datetime
+from operator import attrgetter
+from itemadapter import ItemAdapter
+from itemadapter.adapter import AdapterInterface
+
+
+class Item(object):
+    __slots__ = ()
+    # slots of the class and its bases, set by `item_class`
+    FIELDS = ()
+    # field -> accepted types
+    TYPES = {}
+    # fields which may be None
+    OPTIONAL = ()
+    # field -> (min, max)
+    RANGES = {}
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError('unknown fields of {}: {}'.format(
+                type(self).__name__, ', '.join(sorted(fields))))
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    # document of all fields, in the order of `FIELDS`
+    def to_bson(self):
+        return dict(zip(self.FIELDS, self._values(self)))
+
+    # names of invalid fields
+    def validate(self):
+        invalid = []
+        for name, value in zip(self.FIELDS, self._values(self)):
+            if value is None:
+                if name not in self.OPTIONAL:
+                    invalid.append(name)
+                continue
+            if name in self.TYPES and not isinstance(value, self.TYPES[name]):
+                invalid.append(name)
+            elif name in self.RANGES:
+                low, high = self.RANGES[name]
+                if not low <= value <= high:
+                    invalid.append(name)
+        return invalid
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_bson() == other.to_bson()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(k, v) for k, v in self.to_bson().items()))
+
+
+# `FIELDS` of a class, and one getter of all of them, `_values(item)`
+# returns their tuple
+def item_class(cls):
+    cls.FIELDS = tuple(name for klass in reversed(cls.__mro__)
+                       for name in getattr(klass, '__slots__', ()))
+    cls._values = staticmethod(attrgetter(*cls.FIELDS))
+    return cls
+
+
+# every field of `FIELDS` always exists, None when it is not set, so
+# deleting a field resets it to None
+class SlotsItemAdapter(AdapterInterface):
+
+    @classmethod
+    def is_item_class(cls, item_class):
+        return issubclass(item_class, Item)
+
+    @classmethod
+    def get_field_names_from_class(cls, item_class):
+        return list(item_class.FIELDS)
+
+    def __getitem__(self, field_name):
+        self._check(field_name)
+        return getattr(self.item, field_name)
+
+    def __setitem__(self, field_name, value):
+        self._check(field_name)
+        setattr(self.item, field_name, value)
+
+    def __delitem__(self, field_name):
+        self[field_name] = None
+
+    def __iter__(self):
+        return iter(self.item.FIELDS)
+
+    def __len__(self):
+        return len(self.item.FIELDS)
+
+    def _check(self, field_name):
+        if field_name not in self.item.FIELDS:
+            raise KeyError(field_name)
+
+
+ItemAdapter.ADAPTER_CLASSES.appendleft(SlotsItemAdapter)
+
+
+# http://www.dianping.com/shop/38230595
+@item_class
+class Shop(Item):
+    __slots__ = ('_id', 'url', 'name', 'address', 'telephones', 'average_price',
+                 'average_score', 'score', 'meta')
+    TYPES = {
+        '_id': (str, int),
+        'url': str,
+        'name': str,
+        'address': str,
+        'telephones': list,
+        # 人均
+        'average_price': int,
+        # 红色方块
+        'average_score': int,
+        # 满分 10
+        'score': dict,
+        'meta': dict,
+    }
+    RANGES = {'average_score': (0, 5)}
+
+    def validate(self):
+        invalid = super().validate()
+        if 'name' not in invalid and not self.name:
+            invalid.append('name')
+        return invalid
+
 
-import scrapy
+@item_class
+class Review(Item):
+    __slots__ = ('_id', 'user_id', 'average_score', 'date', 'score', 'description')
+    TYPES = {
+        '_id': int,
+        'user_id': int,
+        'average_score': int,
+        'date': datetime,
+        # 满分 5
+        'score': dict,
+        'description': str,
+    }
+    OPTIONAL = ('average_score',)
+    RANGES = {'average_score': (0, 5)}
 
 
-class DianpingCrawlerItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+@item_class
+class TaggedReview(Review):
+    __slots__ = ('tag', 'tag_sentence')
+    TYPES = dict(Review.TYPES, tag=str, tag_sentence=str)
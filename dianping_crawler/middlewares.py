@@ -4,9 +4,846 @@
 #
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
+import re
+import time
+import random
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import scrapy
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers, HtmlResponse
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import defer
+from . import archive
+from .spiders import extractors
+from .spiders.delta_helper import DeltaHelper
 
 
-class DianpingCrawlerSpiderMiddleware(object):
+# Download slots are composed of named parts, e.g. the proxy and the
+# session of a request, so every combination gets its own budget:
+#
+#   proxy=http://10.0.0.1:8080|session=3
+#
+# a part of None is removed. A part may limit the concurrency and delay of
+# the slot, and the strictest limits of all parts apply, see `configure_slot`
+def set_slot_part(request, name, value, concurrency=None, delay=None):
+    parts = request.meta.setdefault('download_slot_parts', {})
+    limits = request.meta.setdefault('download_slot_limits', {})
+    limits.pop(name, None)
+    if value is None:
+        parts.pop(name, None)
+    else:
+        parts[name] = value
+        if concurrency is not None:
+            limits[name] = (concurrency, delay or 0)
+    if parts:
+        request.meta['download_slot'] = '|'.join(
+            '{}={}'.format(k, parts[k]) for k in sorted(parts))
+    else:
+        request.meta.pop('download_slot', None)
+
+
+# Slots are created by the downloader with defaults of a single IP, and
+# configured once with limits of `set_slot_part` when the request reaches
+# the downloader, so later changes such as backoff of BanDetectionMiddleware
+# are kept. `configured` is slot key -> the slot configured, as slots are
+# recreated after idle
+def configure_slot(downloader, request, configured):
+    limits = list(request.meta.get('download_slot_limits', {}).values())
+    key = request.meta.get('download_slot')
+    slot = downloader.slots.get(key)
+    if not limits or slot is None or configured.get(key) is slot:
+        return
+    slot.concurrency = min(c for c, _ in limits)
+    slot.delay = max(d for _, d in limits)
+    configured[key] = slot
+
+
+# rules of `classify_response` from settings, see `BAN_*`
+def ban_rules(settings):
+    patterns = settings.getlist('BAN_URL_PATTERNS', ['verify.meituan.com', '/verify', 'captcha'])
+    markers = settings.getdict('BAN_REQUIRED_MARKERS', {'detail': 'basic-info'})
+    return {
+        'url_re': re.compile('|'.join(re.escape(p) for p in patterns)) if patterns else None,
+        'codes': set(int(c) for c in settings.getlist('BAN_HTTP_CODES', [403, 429])),
+        'markers': {k: v.encode('utf-8') for k, v in markers.items()},
+        'min_body_size': settings.getint('BAN_MIN_BODY_SIZE', 0),
+    }
+
+
+# Return why a response is a ban or verification page, or None for pages
+# the callback can use:
+#
+# - 'verify':  redirected to, or served from a url of `BAN_URL_PATTERNS`
+# - 'status':  `BAN_HTTP_CODES`
+# - 'marker':  the marker of its callback in `BAN_REQUIRED_MARKERS` is
+#              missing, e.g. `basic-info` of shop detail pages
+# - 'small':   html smaller than `BAN_MIN_BODY_SIZE`
+def classify_response(request, response, url_re=None, codes=(), markers=None,
+                      min_body_size=0):
+    if url_re is not None:
+        location = response.headers.get('Location', b'').decode('latin1')
+        if url_re.search(response.url) or (300 <= response.status < 400 and url_re.search(location)):
+            return 'verify'
+    if response.status in codes:
+        return 'status'
+    if response.status != 200:
+        return None
+    marker = (markers or {}).get(getattr(request.callback, '__name__', None))
+    if marker and marker not in response.body:
+        return 'marker'
+    if isinstance(response, HtmlResponse) and len(response.body) < min_body_size:
+        return 'small'
+    return None
+
+
+class ProfilingSpiderMiddleware(object):
+    """ Record wall and CPU time of every callback, including the time
+    spent in generators of the callback, into stats:
+
+        profile/callback/<name>/{count,wall_seconds,cpu_seconds}
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        # id(response) -> (wall, cpu) when entering the callback
+        self.starts = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PROFILE_ENABLED'):
+            raise NotConfigured
+        return cls(crawler.stats)
+
+    def process_spider_input(self, response, spider):
+        self.starts[id(response)] = (time.perf_counter(), time.process_time())
+
+    def process_spider_output(self, response, result, spider):
+        timing = self.callback_timing(response)
+        if timing is None:
+            return result
+        return self.timed_iter(result, *timing)
+
+    # scrapy 2.13+ iterates outputs of callbacks asynchronously
+    async def process_spider_output_async(self, response, result, spider):
+        timing = self.callback_timing(response)
+        if timing is None:
+            async for x in result:
+                yield x
+            return
+        name, wall, cpu = timing
+        iterator = result.__aiter__()
+        try:
+            while True:
+                wall_start, cpu_start = time.perf_counter(), time.process_time()
+                try:
+                    x = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    wall += time.perf_counter() - wall_start
+                    cpu += time.process_time() - cpu_start
+                yield x
+        finally:
+            self.record(name, wall, cpu)
+
+    def process_spider_exception(self, response, exception, spider):
+        self.starts.pop(id(response), None)
+
+    # (name, wall, cpu) of the callback of a response, so far
+    def callback_timing(self, response):
+        start = self.starts.pop(id(response), None)
+        if start is None:
+            return None
+        wall = time.perf_counter() - start[0]
+        cpu = time.process_time() - start[1]
+        name = getattr(response.request.callback, '__name__', 'parse')
+        return name, wall, cpu
+
+    def timed_iter(self, result, name, wall, cpu):
+        iterator = iter(result or ())
+        try:
+            while True:
+                wall_start, cpu_start = time.perf_counter(), time.process_time()
+                try:
+                    x = next(iterator)
+                finally:
+                    wall += time.perf_counter() - wall_start
+                    cpu += time.process_time() - cpu_start
+                yield x
+        except StopIteration:
+            pass
+        finally:
+            self.record(name, wall, cpu)
+
+    def record(self, name, wall, cpu):
+        prefix = 'profile/callback/{}/'.format(name)
+        self.stats.inc_value(prefix + 'count')
+        self.stats.inc_value(prefix + 'wall_seconds', wall)
+        self.stats.inc_value(prefix + 'cpu_seconds', cpu)
+
+
+class ParseOffloadMiddleware(object):
+    """ Extract fields of responses in a process pool, so parsing scales
+    across cores instead of pinning the reactor thread.
+
+    Responses of callbacks in `extractors.WORKER_PARSERS` are parsed by
+    workers before reaching the spider, the result is passed to the
+    callback as `response.meta['parsed_fields']`. If a worker fails, the
+    callback parses the response by itself.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, processes, normalize=True):
+        # not forked, the crawler process has running threads and open sockets
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+        self.normalize = normalize
+        # imported late, importing it installs the default reactor before
+        # scrapy installs TWISTED_REACTOR
+        from twisted.internet import reactor
+        self.reactor = reactor
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        processes = crawler.settings.getint('PARSER_PROCESSES', 0)
+        if processes <= 0:
+            raise NotConfigured
+        middleware = cls(processes, crawler.settings.getbool('DEMOJIZE_REVIEWS', True))
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_closed(self, spider):
+        self.executor.shutdown(wait=False)
+
+    async def process_response(self, request, response, spider):
+        name = getattr(request.callback, '__name__', None)
+        parser = extractors.WORKER_PARSERS.get(name)
+        if parser is None or response.status != 200:
+            return response
+
+        meta = {k: v for k, v in request.meta.items() if k in ('tag',)}
+        future = self.executor.submit(parser, response.body, response.encoding, meta,
+                                      self.normalize)
+        try:
+            fields = await maybe_deferred_to_future(self.deferred_from_future(future))
+        except Exception as e:
+            self.logger.warning('offloaded parsing of %s failed: %s', request.url, e)
+            return response
+        request.meta['parsed_fields'] = fields
+        return response
+
+    def deferred_from_future(self, future):
+        d = defer.Deferred()
+
+        # called in the executor thread
+        def done(f):
+            error = f.exception()
+            if error is not None:
+                self.reactor.callFromThread(d.errback, error)
+            else:
+                self.reactor.callFromThread(d.callback, f.result())
+
+        future.add_done_callback(done)
+        return d
+
+
+class ProxyHealth(object):
+    """ Moving averages of success rate and latency of a proxy, failing
+    proxies are quarantined with exponential backoff.
+    """
+    # weight of the latest sample
+    ALPHA = 0.2
+
+    def __init__(self, url):
+        self.url = url
+        self.inflight = 0
+        self.success_rate = 1.0
+        self.latency = 0.0
+        self.failures = 0
+        self.quarantines = 0
+        self.quarantined_until = 0
+
+    def available(self, now):
+        return self.quarantined_until <= now
+
+    # proxies of lower load are picked first, relative to their health
+    def load(self):
+        return (self.inflight + 1) / max(self.success_rate, 0.05)
+
+    def succeeded(self, latency):
+        self.success_rate += self.ALPHA * (1 - self.success_rate)
+        self.latency += self.ALPHA * (latency - self.latency)
+        self.failures = 0
+        self.quarantines = max(self.quarantines - 1, 0)
+
+    def failed(self):
+        self.success_rate -= self.ALPHA * self.success_rate
+        self.failures += 1
+
+    def quarantine(self, now, base, limit):
+        self.quarantined_until = now + min(base * 2 ** self.quarantines, limit)
+        self.quarantines += 1
+        self.failures = 0
+
+
+class ProxyPoolMiddleware(object):
+    """ Rotate requests through `PROXIES`, each proxy is a download slot of
+    `PROXY_CONCURRENCY` and `PROXY_DOWNLOAD_DELAY`, so total throughput
+    grows with the number of healthy proxies.
+
+    A request goes to the available proxy of the lowest load relative to
+    its success rate. Ban pages of `classify_response` and download errors
+    are failures, and the request is retried through another proxy
+    up to `PROXY_MAX_RETRIES` times. After `PROXY_MAX_FAILURES` failures in
+    a row a proxy is quarantined, for `PROXY_QUARANTINE` seconds doubled on
+    every quarantine, and evicted after `PROXY_MAX_QUARANTINES`.
+
+    Verification pages of requests of SessionPoolMiddleware are failures of
+    the session instead. Requests with a `proxy` meta set elsewhere are
+    left alone.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, crawler, proxies):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.proxies = [ProxyHealth(url) for url in proxies]
+        self.concurrency = settings.getint('PROXY_CONCURRENCY', 2)
+        self.delay = settings.getfloat('PROXY_DOWNLOAD_DELAY', 1)
+        self.ban_rules = ban_rules(settings)
+        self.max_retries = settings.getint('PROXY_MAX_RETRIES', 5)
+        self.max_failures = settings.getint('PROXY_MAX_FAILURES', 3)
+        self.quarantine_base = settings.getfloat('PROXY_QUARANTINE', 60)
+        self.quarantine_limit = settings.getfloat('PROXY_QUARANTINE_MAX', 3600)
+        self.max_quarantines = settings.getint('PROXY_MAX_QUARANTINES', 5)
+        # slot key -> the slot configured, slots are recreated after idle
+        self.configured = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        proxies = crawler.settings.getlist('PROXIES')
+        if not crawler.settings.getbool('PROXY_POOL_ENABLED') or not proxies:
+            raise NotConfigured
+        middleware = cls(crawler, proxies)
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(middleware.request_reached_downloader,
+                                signal=signals.request_reached_downloader)
+        return middleware
+
+    def spider_opened(self, spider):
+        # CONCURRENT_REQUESTS of a single IP would cap the whole pool
+        downloader = self.crawler.engine.downloader
+        total = len(self.proxies) * self.concurrency
+        if 0 < downloader.total_concurrency < total:
+            self.logger.info('raise concurrent requests from %s to %s for %s proxies',
+                             downloader.total_concurrency, total, len(self.proxies))
+            downloader.total_concurrency = total
+
+    def spider_closed(self, spider):
+        self.stats.set_value('proxy_pool/healthy', len(self.proxies))
+        for p in self.proxies:
+            self.logger.info('proxy %s: success rate %.2f, latency %.3fs, quarantined %s times',
+                             p.url, p.success_rate, p.latency, p.quarantines)
+
+    def request_reached_downloader(self, request, spider):
+        configure_slot(self.crawler.engine.downloader, request, self.configured)
+
+    def pick(self):
+        now = time.time()
+        available = [p for p in self.proxies if p.available(now)]
+        if not available:
+            # the one released first, rather than exposing our own IP
+            return min(self.proxies, key=lambda p: p.quarantined_until)
+        random.shuffle(available)
+        return min(available, key=ProxyHealth.load)
+
     def process_request(self, request, spider):
-        cookies = spider.settings.get('COOKIES', {})
-        request.cookies.update(cookies)
+        if 'proxy' in request.meta and 'proxy_health' not in request.meta:
+            return
+        if not self.proxies:
+            return
+        proxy = self.pick()
+        proxy.inflight += 1
+        request.meta['proxy'] = proxy.url
+        request.meta['proxy_health'] = proxy
+        request.meta['proxy_start'] = time.time()
+        set_slot_part(request, 'proxy', proxy.url, self.concurrency, self.delay)
+
+    def process_response(self, request, response, spider):
+        proxy, latency = self.release(request)
+        if proxy is None:
+            return response
+        reason = classify_response(request, response, **self.ban_rules)
+        if reason is None:
+            proxy.succeeded(latency)
+            return response
+        # verification pages challenge the session, which is left to
+        # SessionPoolMiddleware, and the page to BanDetectionMiddleware
+        if reason == 'verify' and 'session' in request.meta:
+            proxy.succeeded(latency)
+            return response
+
+        self.stats.inc_value('proxy_pool/banned')
+        self.fail(proxy)
+        return self.retry(request, reason) or response
+
+    def process_exception(self, request, exception, spider):
+        proxy, _ = self.release(request)
+        if proxy is None:
+            return None
+        self.stats.inc_value('proxy_pool/error')
+        self.fail(proxy)
+        return self.retry(request, exception)
+
+    # return (proxy, latency), a request is released once
+    def release(self, request):
+        start = request.meta.pop('proxy_start', None)
+        if start is None:
+            return None, None
+        proxy = request.meta['proxy_health']
+        proxy.inflight -= 1
+        return proxy, time.time() - start
+
+    def fail(self, proxy):
+        proxy.failed()
+        if proxy.failures < self.max_failures or proxy not in self.proxies:
+            return
+        if proxy.quarantines >= self.max_quarantines:
+            self.proxies.remove(proxy)
+            self.stats.inc_value('proxy_pool/evicted')
+            self.logger.warning('evict proxy %s, %s proxies left', proxy.url, len(self.proxies))
+            return
+        proxy.quarantine(time.time(), self.quarantine_base, self.quarantine_limit)
+        self.stats.inc_value('proxy_pool/quarantined')
+        self.logger.info('quarantine proxy %s for %.0f seconds', proxy.url,
+                         proxy.quarantined_until - time.time())
+
+    # through another proxy, picked by `process_request` again
+    def retry(self, request, reason):
+        retries = request.meta.get('proxy_retry_times', 0) + 1
+        if retries > self.max_retries:
+            self.logger.debug('gave up retrying %s through proxies: %s', request.url, reason)
+            return None
+        self.stats.inc_value('proxy_pool/retry')
+        retry = request.replace(dont_filter=True)
+        retry.meta['proxy_retry_times'] = retries
+        for key in ('proxy', 'proxy_health', 'proxy_start'):
+            retry.meta.pop(key, None)
+        set_slot_part(retry, 'proxy', None)
+        SessionPoolMiddleware.forget(retry)
+        return retry
+
+
+# "a=1; b=2" -> OrderedDict([('a', '1'), ('b', '2')])
+def parse_cookies(line):
+    cookies = OrderedDict()
+    for pair in line.split(';'):
+        name, sep, value = pair.strip().partition('=')
+        if name and sep:
+            cookies[name] = value
+    return cookies
+
+
+class Session(object):
+    """ A cookie jar, updated by `Set-Cookie` of responses, with counts of
+    requests and ban pages of the session.
+    """
+
+    def __init__(self, id, cookies):
+        self.id = id
+        self.cookies = cookies
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+        self.retired = False
+
+    def header(self):
+        return '; '.join('{}={}'.format(k, v) for k, v in self.cookies.items())
+
+    def update(self, set_cookies):
+        for value in set_cookies:
+            self.cookies.update(parse_cookies(value.decode('latin1').split(';', 1)[0]))
+
+
+class SessionPoolMiddleware(object):
+    """ Rotate requests through cookie jars of `SESSIONS_FILE`, one jar per
+    line in the format of `COOKIES`, or the single jar of `COOKIES` if no
+    file is given. Each session is a download slot part of
+    `SESSION_CONCURRENCY` and `SESSION_DOWNLOAD_DELAY`, so sustained
+    request rate grows with the number of sessions.
+
+    The `Cookie` header is set directly, so COOKIES_ENABLED can stay off.
+    A session is retired when it gets a verification page, or after
+    `SESSION_MAX_FAILURES` other ban pages (see `classify_response`) in a
+    row. The page itself is requeued by `ProxyPoolMiddleware` or
+    `BanDetectionMiddleware`, which see responses after this one, with
+    another session. The last active session is never retired, it goes on
+    slowed down by the backoff of `BanDetectionMiddleware`, like a crawl
+    without a pool would.
+
+    Requests with a `Cookie` header set elsewhere are left alone.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, crawler, jars):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.sessions = [Session(i, cookies) for i, cookies in enumerate(jars)]
+        self.concurrency = settings.getint('SESSION_CONCURRENCY', 1)
+        self.delay = settings.getfloat('SESSION_DOWNLOAD_DELAY', 1)
+        self.max_failures = settings.getint('SESSION_MAX_FAILURES', 3)
+        self.ban_rules = ban_rules(settings)
+        self.configured = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('SESSION_POOL_ENABLED'):
+            raise NotConfigured
+        path = settings.get('SESSIONS_FILE')
+        if path:
+            jars = cls.load_jars(path)
+        else:
+            jars = [OrderedDict(settings.getdict('COOKIES'))]
+        jars = [jar for jar in jars if jar]
+        if not jars:
+            raise NotConfigured('no session')
+        middleware = cls(crawler, jars)
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(middleware.request_reached_downloader,
+                                signal=signals.request_reached_downloader)
+        return middleware
+
+    # one jar per line, empty lines and lines of "#" are skipped
+    @staticmethod
+    def load_jars(path):
+        with open(path, encoding='utf-8') as f:
+            return [parse_cookies(line) for line in f
+                    if line.strip() and not line.startswith('#')]
+
+    @property
+    def active(self):
+        return [s for s in self.sessions if not s.retired]
+
+    def spider_opened(self, spider):
+        self.logger.info('session pool of %s sessions', len(self.sessions))
+        # CONCURRENT_REQUESTS of a single session would cap the whole pool
+        downloader = self.crawler.engine.downloader
+        total = len(self.sessions) * self.concurrency
+        if 0 < downloader.total_concurrency < total:
+            self.logger.info('raise concurrent requests from %s to %s for %s sessions',
+                             downloader.total_concurrency, total, len(self.sessions))
+            downloader.total_concurrency = total
+
+    def spider_closed(self, spider):
+        self.stats.set_value('session_pool/active', len(self.active))
+        for s in self.sessions:
+            self.logger.info('session %s: %s requests, %s failures%s', s.id, s.requests,
+                             s.failures, ', retired' if s.retired else '')
+
+    def request_reached_downloader(self, request, spider):
+        configure_slot(self.crawler.engine.downloader, request, self.configured)
+
+    def pick(self):
+        active = self.active
+        random.shuffle(active)
+        return min(active, key=lambda s: s.inflight)
+
+    def process_request(self, request, spider):
+        if b'Cookie' in request.headers and 'session' not in request.meta:
+            return
+        # a copy of a request which was never released, e.g. a retry of a
+        # middleware which saw the response or exception first
+        self.release(request)
+        session = self.pick()
+        session.inflight += 1
+        session.requests += 1
+        self.stats.inc_value('session_pool/requests')
+        request.meta['session'] = session
+        request.meta['session_pending'] = True
+        request.headers['Cookie'] = session.header()
+        set_slot_part(request, 'session', session.id, self.concurrency, self.delay)
+
+    def process_response(self, request, response, spider):
+        session = self.release(request)
+        if session is None:
+            return response
+        session.update(response.headers.getlist('Set-Cookie'))
+        reason = classify_response(request, response, **self.ban_rules)
+        if reason is None:
+            session.failures = 0
+            return response
+
+        self.stats.inc_value('session_pool/banned')
+        session.failures += 1
+        if reason == 'verify' or session.failures >= self.max_failures:
+            self.retire(session, reason)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self.release(request)
+
+    # return the session of the request, a request is released once
+    @staticmethod
+    def release(request):
+        if not request.meta.pop('session_pending', False):
+            return None
+        session = request.meta['session']
+        session.inflight -= 1
+        return session
+
+    # for requeued copies of a request, which are given another session by
+    # `process_request`. The session is released if nothing did it yet
+    @classmethod
+    def forget(cls, request):
+        if 'session' not in request.meta:
+            return
+        cls.release(request)
+        del request.meta['session']
+        request.headers.pop('Cookie', None)
+        set_slot_part(request, 'session', None)
+
+    def retire(self, session, reason):
+        if session.retired:
+            return
+        if len(self.active) == 1:
+            session.failures = 0
+            self.stats.inc_value('session_pool/kept_last')
+            self.logger.warning('keep the last session %s (%s)', session.id, reason)
+            return
+        session.retired = True
+        self.stats.inc_value('session_pool/retired')
+        self.logger.warning('retire session %s (%s) after %s requests, %s sessions left',
+                            session.id, reason, session.requests, len(self.active))
+
+
+class BanDetectionMiddleware(object):
+    """ Stop ban and verification pages (see `classify_response`) before
+    they reach callbacks, which would extract empty fields and mark the
+    request as finished.
+
+    The request is requeued up to `BAN_MAX_RETRIES` times and dropped
+    after that, unfinished in delta. The download delay of its slot, i.e.
+    the proxy or session which got banned, is doubled up to
+    `BAN_BACKOFF_MAX_DELAY`, and recovers by `BAN_BACKOFF_RECOVERY` on
+    every good response.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.rules = ban_rules(settings)
+        self.max_retries = settings.getint('BAN_MAX_RETRIES', 3)
+        self.max_delay = settings.getfloat('BAN_BACKOFF_MAX_DELAY', 60)
+        self.recovery = settings.getfloat('BAN_BACKOFF_RECOVERY', 0.9)
+        # slot key -> delay before the first ban
+        self.base_delays = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('BAN_DETECTION_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def slot(self, request):
+        slots = self.crawler.engine.downloader.slots
+        key = request.meta.get('download_slot')
+        return key, slots.get(key)
+
+    def process_response(self, request, response, spider):
+        reason = classify_response(request, response, **self.rules)
+        key, slot = self.slot(request)
+        if reason is None:
+            if slot is not None and key in self.base_delays:
+                self.recover(key, slot)
+            return response
+
+        self.stats.inc_value('ban/{}'.format(reason))
+        if slot is not None:
+            self.backoff(key, slot)
+
+        retries = request.meta.get('ban_retry_times', 0) + 1
+        if retries > self.max_retries:
+            self.stats.inc_value('ban/gave_up')
+            raise IgnoreRequest('banned ({}): {}'.format(reason, request.url))
+        self.logger.debug('banned (%s), requeue %s', reason, request.url)
+        retry = request.replace(dont_filter=True)
+        retry.meta['ban_retry_times'] = retries
+        SessionPoolMiddleware.forget(retry)
+        return retry
+
+    def backoff(self, key, slot):
+        base = self.base_delays.setdefault(key, slot.delay)
+        delay = min(max(slot.delay * 2, base, 1), self.max_delay)
+        if delay != slot.delay:
+            self.logger.info('back off slot %s to %.1f seconds', key, delay)
+        slot.delay = delay
+
+    def recover(self, key, slot):
+        base = self.base_delays[key]
+        slot.delay = max(slot.delay * self.recovery, base)
+        if slot.delay <= base:
+            del self.base_delays[key]
+
+
+class ArchiveMiddleware(object):
+    """ Store good responses in the segment files of `ARCHIVE_DIR`, keyed
+    by the delta fingerprint of their request, so callbacks can be run
+    again over them by `scrapy reparse` without downloading anything.
+
+    Responses are archived after `BanDetectionMiddleware`, so ban pages
+    are not, and only pages with status 200 are.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, stats, writer):
+        self.stats = stats
+        self.writer = writer
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ARCHIVE_ENABLED'):
+            raise NotConfigured
+        writer = archive.SegmentWriter(settings.get('ARCHIVE_DIR', 'archive'),
+                                       settings.getint('ARCHIVE_SEGMENT_SIZE', 256 * 1024 * 1024),
+                                       settings.get('ARCHIVE_CODEC', 'zstd'),
+                                       settings.getint('ARCHIVE_COMPRESSION_LEVEL', 3))
+        middleware = cls(crawler.stats, writer)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_closed(self, spider):
+        self.writer.close()
+
+    def process_response(self, request, response, spider):
+        if response.status != 200:
+            return response
+        info = {
+            'url': response.url,
+            'status': response.status,
+            'headers': DeltaHelper.headers_serialize(response.headers),
+            'request_url': request.url,
+            'method': request.method,
+            'callback': DeltaHelper.callable_name(request.callback),
+            'meta': DeltaHelper.meta_serialize(request.meta),
+            'time': time.time(),
+        }
+        fingerprint = DeltaHelper.request_fingerprint(request.method, request.url)
+        size = self.writer.write(fingerprint, info, response.body)
+        self.stats.inc_value('archive/records')
+        self.stats.inc_value('archive/raw_bytes', len(response.body))
+        self.stats.inc_value('archive/bytes', size)
+        return response
+
+
+class ReplayStartMiddleware(object):
+    """ Replace start requests of the spider with requests of the latest
+    archived response of every fingerprint, of the shard of this process,
+    see `scrapy reparse`.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.directory = settings.get('ARCHIVE_DIR', 'archive')
+        self.shard_index = settings.getint('REPLAY_SHARD_INDEX', 0)
+        self.shard_count = settings.getint('REPLAY_SHARD_COUNT', 1)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('REPLAY_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    # start requests of the spider are not consumed, but `start_requests` is
+    # called, so the spider is initialized
+    async def process_start(self, start):
+        spider = self.crawler.spider
+        spider.start_requests()
+        for request in self.archived_requests(spider):
+            yield request
+
+    # scrapy < 2.13
+    def process_start_requests(self, start_requests, spider):
+        return self.archived_requests(spider)
+
+    def archived_requests(self, spider):
+        records = archive.index_archive(self.directory, self.shard_index, self.shard_count)
+        self.logger.info('replay %d archived responses of shard %d/%d', len(records),
+                         self.shard_index, self.shard_count)
+        # in order of segments and offsets, so reads are sequential
+        f = None
+        for path, offset in sorted(records.values()):
+            if f is None or f.name != path:
+                if f is not None:
+                    f.close()
+                f = open(path, 'rb')
+            info = archive.read_record_info(f, offset)
+            callback = info['callback']
+            if callback is not None and not hasattr(spider, callback):
+                self.stats.inc_value('replay/unknown_callback')
+                continue
+            request = scrapy.Request(info['request_url'], method=info['method'],
+                                     callback=getattr(spider, callback) if callback else None,
+                                     meta=DeltaHelper.meta_deserialize(info['meta']),
+                                     dont_filter=True)
+            request.meta['archive_record'] = (path, offset)
+            yield request
+        if f is not None:
+            f.close()
+
+
+class ReplayMiddleware(object):
+    """ Serve requests of `ReplayStartMiddleware` from the archive, and
+    drop any other request, so nothing is downloaded.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, stats):
+        self.stats = stats
+        # path -> opened segment
+        self.files = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('REPLAY_ENABLED'):
+            raise NotConfigured
+        middleware = cls(crawler.stats)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_closed(self, spider):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+    def process_request(self, request, spider):
+        record = request.meta.get('archive_record')
+        if record is None:
+            self.stats.inc_value('replay/dropped')
+            raise IgnoreRequest('not archived: {}'.format(request.url))
+
+        path, offset = record
+        if path not in self.files:
+            self.files[path] = open(path, 'rb')
+        info, body = archive.read_record(self.files[path], offset)
+        headers = Headers(info['headers'] or {})
+        cls = responsetypes.from_args(headers=headers, url=info['url'], body=body)
+        self.stats.inc_value('replay/responses')
+        return cls(url=info['url'], status=info['status'], headers=headers, body=body,
+                   request=request)
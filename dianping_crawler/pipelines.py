@@ -4,7 +4,23 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
+import json
+import hashlib
+import logging
 import pymongo
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from scrapy.exceptions import DropItem
+from twisted.internet import task
+from .items import Item
+from .storage import get_storage
+
+
+# items are `items.Item`s, or dicts
+def to_document(item):
+    return item.to_bson() if isinstance(item, Item) else item
 
 
 class DianpingCrawlerPipeline(object):
@@ -79,15 +95,23 @@ class DianpingCrawlerPipeline(object):
         ]
     }
 
-    def __init__(self, mongo_uri, mongo_db):
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, mongo_uri, mongo_db, storage, stats, validation=False):
         self.mongo_uri = mongo_uri
         self.mongo_db = mongo_db
+        self.storage = storage
+        self.stats = stats
+        self.validation = validation
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(
             mongo_uri=crawler.settings.get('MONGO_URI'),
-            mongo_db=crawler.settings.get('MONGO_DATABASE', 'dianping')
+            mongo_db=crawler.settings.get('MONGO_DATABASE', 'dianping'),
+            storage=get_storage(crawler),
+            stats=crawler.stats,
+            validation=crawler.settings.getbool('ITEM_VALIDATION', False),
         )
 
     def open_spider(self, _spider):
@@ -95,11 +119,223 @@ class DianpingCrawlerPipeline(object):
         self.db = self.client[self.mongo_db]
 
     def close_spider(self, _spider):
-        self.client.close()
+        d = self.storage.drain()
+        d.addBoth(lambda _: self.client.close())
+        return d
 
     def process_item(self, item, spider):
+        self.check_item(item, spider)
+        doc = to_document(item)
+        d = self.storage.call(self.insert_item, doc, spider)
+        d.addCallback(self.count_written, spider)
+        d.addErrback(self.storage.log_error, 'insert {}'.format(doc.get('_id')))
+        d.addCallback(lambda _: item)
+        return d
+
+    # drop items of invalid fields, when ITEM_VALIDATION is enabled
+    def check_item(self, item, spider):
+        if not self.validation or not isinstance(item, Item):
+            return
+        invalid = item.validate()
+        if not invalid:
+            return
+        self.stats.inc_value('item/invalid', spider=spider)
+        for name in invalid:
+            self.stats.inc_value('item/invalid/{}'.format(name), spider=spider)
+        raise DropItem('invalid {} of {} {}'.format(
+            ', '.join(invalid), type(item).__name__, item._id))
+
+    # run in storage backend, return counts of stats under `mongodb/`
+    def insert_item(self, item, spider):
         try:
             self.db[spider.name].insert_one(item)
-        except Exception as e:
-            print(e)
+            return {'inserted': 1}
+        except DuplicateKeyError:
+            return {'duplicate_key': 1}
+
+    def count_written(self, counts, spider):
+        for name, count in counts.items():
+            self.stats.inc_value('mongodb/' + name, count, spider=spider)
+
+
+class BufferedMongoPipeline(DianpingCrawlerPipeline):
+    """ Collect items per collection (i.e. `spider.name`), and write them
+    with one unordered `insert_many` (or `bulk_write` of upserts) when
+    the buffer is full, by timer and on spider closed.
+
+    With `change_detection`, items are compared with the stored ones by
+    `content_hash`, see `write_changed_items`. Items of `scrapy reparse`
+    are written by `write_replayed_items`.
+    """
+    # fields maintained by `write_changed_items`, not part of the content
+    TRACKING_FIELDS = (
+        'content_hash', 'first_seen', 'last_seen', 'last_changed',
+        'seen_count', 'change_count', 'recrawl_interval', 'next_crawl',
+    )
+
+    def __init__(self, mongo_uri, mongo_db, storage, stats, validation=False,
+                 buffer_size=100, flush_interval=10, upsert=False,
+                 change_detection=False, recrawl_interval=(7, 1, 60), replay=False):
+        super().__init__(mongo_uri, mongo_db, storage, stats, validation)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.upsert = upsert
+        self.change_detection = change_detection
+        # (initial, min, max) in days
+        self.recrawl_interval = recrawl_interval
+        self.replay = replay
+        self.buffers = defaultdict(list)
+        self.flush_task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            mongo_uri=crawler.settings.get('MONGO_URI'),
+            mongo_db=crawler.settings.get('MONGO_DATABASE', 'dianping'),
+            storage=get_storage(crawler),
+            stats=crawler.stats,
+            validation=crawler.settings.getbool('ITEM_VALIDATION', False),
+            buffer_size=crawler.settings.getint('PIPELINE_BUFFER_SIZE', 100),
+            flush_interval=crawler.settings.getfloat('PIPELINE_FLUSH_INTERVAL', 10),
+            upsert=crawler.settings.getbool('PIPELINE_UPSERT', False),
+            change_detection=crawler.settings.getbool('PIPELINE_CHANGE_DETECTION', False),
+            recrawl_interval=(
+                crawler.settings.getfloat('RECRAWL_INTERVAL', 7),
+                crawler.settings.getfloat('RECRAWL_MIN_INTERVAL', 1),
+                crawler.settings.getfloat('RECRAWL_MAX_INTERVAL', 60),
+            ),
+            replay=crawler.settings.getbool('REPLAY_ENABLED', False),
+        )
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        self.flush_task = task.LoopingCall(self.flush, spider)
+        self.flush_task.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider):
+        if self.flush_task and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush(spider)
+        return super().close_spider(spider)
+
+    # items are buffered as they are, and turned into documents when written
+    def process_item(self, item, spider):
+        self.check_item(item, spider)
+        buffer = self.buffers[spider.name]
+        buffer.append(item)
+        if len(buffer) >= self.buffer_size:
+            self.flush_collection(spider.name, spider)
         return item
+
+    def flush(self, spider):
+        for name in list(self.buffers.keys()):
+            self.flush_collection(name, spider)
+
+    def flush_collection(self, name, spider):
+        items = self.buffers.pop(name, None)
+        if not items:
+            return
+        d = self.storage.call(self.write_items, name, items)
+        d.addCallback(self.count_written, spider)
+        d.addErrback(self.storage.log_error, 'write {} items to {}'.format(len(items), name))
+
+    # run in storage backend, return counts of stats under `mongodb/`
+    def write_items(self, name, items):
+        items = [to_document(item) for item in items]
+        collection = self.db[name]
+        if self.replay:
+            return self.write_replayed_items(collection, items)
+        if self.change_detection:
+            return self.write_changed_items(collection, items)
+        try:
+            if self.upsert:
+                operations = [ReplaceOne({'_id': item['_id']}, item, upsert=True)
+                              for item in items]
+                collection.bulk_write(operations, ordered=False)
+            else:
+                collection.insert_many(items, ordered=False)
+            return {'inserted': len(items)}
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            duplicated = sum(1 for err in errors if err['code'] == 11000)
+            others = [err for err in errors if err['code'] != 11000]
+            if others:
+                self.logger.error('write items to %s failed: %s', name, others)
+            return {'inserted': len(items) - len(errors), 'duplicate_key': duplicated}
+
+    @classmethod
+    def content_hash(cls, item):
+        content = {k: v for k, v in item.items()
+                   if k != '_id' and k not in cls.TRACKING_FIELDS}
+        data = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+    # Days until the next crawl, halved when the item changed and grown by
+    # half when not, so volatile items are revisited more often
+    def next_recrawl_interval(self, previous, changed):
+        initial, low, high = self.recrawl_interval
+        if previous is None:
+            return initial
+        interval = previous / 2 if changed else previous * 1.5
+        return min(max(interval, low), high)
+
+    # One read of stored hashes per buffer: unchanged items only touch their
+    # tracking fields, new or changed items are upserted as a whole
+    def write_changed_items(self, collection, items):
+        now = datetime.utcnow()
+        ids = [item['_id'] for item in items]
+        projection = {'content_hash': 1, 'recrawl_interval': 1}
+        stored = {doc['_id']: doc for doc in collection.find({'_id': {'$in': ids}}, projection)}
+
+        operations = []
+        counts = defaultdict(int)
+        for item in items:
+            doc = stored.get(item['_id'], {})
+            content_hash = self.content_hash(item)
+            changed = doc.get('content_hash') != content_hash
+            interval = self.next_recrawl_interval(doc.get('recrawl_interval'), changed)
+            tracking = {
+                'last_seen': now,
+                'recrawl_interval': interval,
+                'next_crawl': now + timedelta(days=interval),
+            }
+
+            if not changed:
+                update = {'$set': tracking, '$inc': {'seen_count': 1}}
+                counts['unchanged'] += 1
+            else:
+                fields = {k: v for k, v in item.items() if k != '_id'}
+                fields.update(tracking, content_hash=content_hash, last_changed=now)
+                update = {
+                    '$set': fields,
+                    '$setOnInsert': {'first_seen': now},
+                    '$inc': {'seen_count': 1, 'change_count': 1 if doc else 0},
+                }
+                counts['changed' if doc else 'inserted'] += 1
+            operations.append(UpdateOne({'_id': item['_id']}, update, upsert=True))
+
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            self.logger.error('write items to %s failed: %s', collection.name,
+                              e.details['writeErrors'])
+        return counts
+
+    # Items re-extracted from archived responses tell nothing about the
+    # site, so only their fields and content_hash are written, and the
+    # recrawl schedule, i.e. last_seen, seen_count, change_count,
+    # recrawl_interval and next_crawl, is left alone
+    def write_replayed_items(self, collection, items):
+        operations = []
+        for item in items:
+            fields = {k: v for k, v in item.items() if k != '_id'}
+            if self.change_detection:
+                fields['content_hash'] = self.content_hash(item)
+            operations.append(UpdateOne({'_id': item['_id']}, {'$set': fields}, upsert=True))
+
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            self.logger.error('write items to %s failed: %s', collection.name,
+                              e.details['writeErrors'])
+        return {'replayed': len(items)}
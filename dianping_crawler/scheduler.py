@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# Scheduler queues
+#
+# `FairPriorityQueue` keeps one sub-queue per city and stage (the priority
+# of requests), so cities make progress concurrently instead of one after
+# another. `CompactDiskQueue` stores requests of JOBDIR by the compact
+# serialization of the delta collection.
+import bson
+import logging
+from queuelib import FifoDiskQueue
+from scrapy.http import Headers
+from .spiders.delta_helper import DeltaHelper
+
+
+class SmoothWeightedRoundRobin(object):
+    """ Serve keys in proportion to their weights, interleaved as evenly
+    as possible, e.g. weights a=2 b=1 serve a b a a b a ...
+    """
+
+    def __init__(self):
+        self.currents = {}
+
+    def pick(self, keys, weight):
+        best, total = None, 0
+        for key in keys:
+            w = weight(key)
+            total += w
+            self.currents[key] = self.currents.get(key, 0) + w
+            if best is None or self.currents[key] > self.currents[best]:
+                best = key
+        if best is not None:
+            self.currents[best] -= total
+        return best
+
+    def discard(self, key):
+        self.currents.pop(key, None)
+
+
+class FairPriorityQueue(object):
+    """ Priority queue of `SCHEDULER_PRIORITY_QUEUE`, with a sub-queue per
+    city (`city_id` of the context of meta) and stage (the priority of the
+    request).
+
+    Cities are served by weighted round-robin, weights are
+    `SCHEDULER_CITY_WEIGHTS` of city id -> weight, 1 by default. Within a
+    city, stages of higher priority are served first, like the default
+    queue does, unless `SCHEDULER_STAGE_WEIGHTS` of priority -> weight is
+    set, then stages are served by weighted round-robin too.
+
+    Sub-queues are named "<city>_<priority>", and are directories of
+    JOBDIR with disk queues.
+    """
+    logger = logging.getLogger(__name__)
+    NO_CITY = 'none'
+
+    def __init__(self, crawler, downstream_queue_cls, key, startprios=(), start_queue_cls=None):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.downstream_queue_cls = downstream_queue_cls
+        self.key = key
+        self.city_weights = {str(k): float(v) for k, v in
+                             settings.getdict('SCHEDULER_CITY_WEIGHTS').items()}
+        self.stage_weights = {int(k): float(v) for k, v in
+                              settings.getdict('SCHEDULER_STAGE_WEIGHTS').items()}
+        # city -> {priority: queue}
+        self.queues = {}
+        self.cities = SmoothWeightedRoundRobin()
+        # city -> round-robin of its stages
+        self.stages = {}
+        for name in startprios or ():
+            city, _, priority = name.rpartition('_')
+            q = self.qfactory(name)
+            if q:
+                self.queues.setdefault(city, {})[int(priority)] = q
+            else:
+                q.close()
+
+    # start requests are queued like other requests
+    @classmethod
+    def from_crawler(cls, crawler, downstream_queue_cls, key, startprios=(), start_queue_cls=None):
+        return cls(crawler, downstream_queue_cls, key, startprios, start_queue_cls)
+
+    def qfactory(self, name):
+        queue_cls = self.downstream_queue_cls
+        path = '{}/{}'.format(self.key, name)
+        if hasattr(queue_cls, 'from_crawler'):
+            return queue_cls.from_crawler(self.crawler, path)
+        return queue_cls(path)
+
+    def city(self, request):
+        context = request.meta.get('context')
+        city_id = context.city_id if context is not None else None
+        return self.NO_CITY if city_id is None else str(city_id)
+
+    def push(self, request):
+        city = self.city(request)
+        stages = self.queues.setdefault(city, {})
+        if request.priority not in stages:
+            stages[request.priority] = self.qfactory('{}_{}'.format(city, request.priority))
+        stages[request.priority].push(request)
+
+    def pop(self):
+        city = self.cities.pick(sorted(self.queues), self.city_weight)
+        if city is None:
+            return None
+        stages = self.queues[city]
+        if self.stage_weights:
+            rr = self.stages.setdefault(city, SmoothWeightedRoundRobin())
+            priority = rr.pick(sorted(stages), self.stage_weight)
+        else:
+            priority = max(stages)
+
+        q = stages[priority]
+        request = q.pop()
+        if not q:
+            q.close()
+            del stages[priority]
+            if city in self.stages:
+                self.stages[city].discard(priority)
+        if not stages:
+            del self.queues[city]
+            self.cities.discard(city)
+            self.stages.pop(city, None)
+        return request
+
+    def city_weight(self, city):
+        return self.city_weights.get(city, 1)
+
+    def stage_weight(self, priority):
+        return self.stage_weights.get(priority, 1)
+
+    # names of sub-queues left, to resume from
+    def close(self):
+        active = []
+        for city, stages in self.queues.items():
+            for priority, q in stages.items():
+                active.append('{}_{}'.format(city, priority))
+                q.close()
+        self.queues = {}
+        return active
+
+    def __len__(self):
+        return sum(len(q) for stages in self.queues.values() for q in stages.values())
+
+
+class CompactDiskQueue(object):
+    """ FIFO disk queue of `SCHEDULER_DISK_QUEUE`, which stores requests
+    as BSON of `DeltaHelper.request_serialize`, i.e. only fields needed to
+    rebuild them, and the context and `META_FIELDS` of meta, instead of pickles of whole
+    requests. `dont_filter` and the retry counters of `RETRY_META` are kept
+    too, so requeued requests are not filtered as duplicates after a
+    restart, and their retries stay bounded. Headers equal to
+    `DEFAULT_REQUEST_HEADERS` are left out, and so are credentials of
+    `CREDENTIAL_HEADERS`: they are set again by the session and proxy pools
+    when requests are downloaded, a stale one must not bypass them.
+
+    Requests of callbacks which are not spider methods are refused with
+    ValueError, so the scheduler keeps them in memory.
+    """
+    # counters of RetryMiddleware, BanDetectionMiddleware and ProxyPoolMiddleware
+    RETRY_META = ('retry_times', 'ban_retry_times', 'proxy_retry_times')
+    CREDENTIAL_HEADERS = ('Cookie', 'Authorization', 'Proxy-Authorization')
+
+    def __init__(self, crawler, key):
+        self.crawler = crawler
+        self.default_headers = Headers(crawler.settings.getdict('DEFAULT_REQUEST_HEADERS'))
+        self.queue = FifoDiskQueue(key)
+
+    @classmethod
+    def from_crawler(cls, crawler, key, *args, **kwargs):
+        return cls(crawler, key)
+
+    def push(self, request):
+        spider = self.crawler.spider
+        for func in (request.callback, request.errback):
+            name = DeltaHelper.callable_name(func)
+            if name is not None and getattr(spider, name, None) != func:
+                raise ValueError('not a method of the spider: {}'.format(func))
+        serialized = DeltaHelper.request_serialize(request, self.default_headers)
+        serialized.pop('_id')
+        serialized.pop('finished')
+        headers = serialized.pop('headers', None) or {}
+        for k in self.CREDENTIAL_HEADERS:
+            headers.pop(k, None)
+        if headers:
+            serialized['headers'] = headers
+        if request.dont_filter:
+            serialized['dont_filter'] = True
+        retries = {k: request.meta[k] for k in self.RETRY_META if k in request.meta}
+        if retries:
+            serialized['retries'] = retries
+        self.queue.push(bson.BSON.encode(serialized))
+
+    def pop(self):
+        data = self.queue.pop()
+        if data is None:
+            return None
+        serialized = bson.BSON(data).decode()
+        request = DeltaHelper.request_deserialize(self.crawler.spider, serialized)
+        request.dont_filter = serialized.get('dont_filter', False)
+        request.meta.update(serialized.get('retries', {}))
+        return request
+
+    def close(self):
+        self.queue.close()
+
+    def __len__(self):
+        return len(self.queue)
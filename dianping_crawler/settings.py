@@ -10,6 +10,22 @@
 #     http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
 HOST = 'http://www.dianping.com'
 
+# 'pyquery', or 'lxml' which parses pages once and reads fields with
+# precompiled XPaths
+PARSER_ENGINE = 'lxml'
+# extract shop and review pages in this many worker processes, see
+# `ParseOffloadMiddleware`; 0 parses in callbacks on the reactor thread
+PARSER_PROCESSES = 0
+# replace emoji in review text with their names, e.g. :thumbs_up:; False
+# stores the raw text, to normalize at export time
+DEMOJIZE_REVIEWS = True
+# 'embedded' pushes reviews into lists of the shop document in `review`,
+# 'normalized' upserts one document per review into `reviews`
+REVIEW_LAYOUT = 'normalized'
+# only crawl reviews newer than the newest review crawled of each shop,
+# for daily refreshes after a full crawl
+REVIEW_INCREMENTAL = False
+
 CITY_IDS = [
     (2, 'beijing'),
 ]
@@ -19,20 +35,130 @@ COOKIES = 'showNav=#nav-tab|0|0; navCtgScroll=0; navCtgScroll=0; _hc.v=a38e4721-
 # convert cookies string to dict
 COOKIES = dict([tuple(p.strip().split('=', 1)) for p in COOKIES.split(';')])
 
+# rotate requests through cookie jars, see `SessionPoolMiddleware`
+SESSION_POOL_ENABLED = True
+# one jar per line in the format of COOKIES above, None to use COOKIES only
+SESSIONS_FILE = None
+# download slot of every session
+SESSION_CONCURRENCY = 1
+SESSION_DOWNLOAD_DELAY = 1
+# retire a session on verification pages, or after this many other BAN_*
+# pages in a row, except the last active one
+SESSION_MAX_FAILURES = 3
+
 PROXIES = [
     # spec https://github.com/constverum/ProxyBroker
     'http://127.0.0.1:8888',
 ]
+# rotate requests through PROXIES, see `ProxyPoolMiddleware`
+PROXY_POOL_ENABLED = False
+# download slot of every proxy
+PROXY_CONCURRENCY = 2
+PROXY_DOWNLOAD_DELAY = 1
+# retries through another proxy on errors and BAN_* pages
+PROXY_MAX_RETRIES = 5
+# quarantine a proxy after failures in a row, for seconds doubled on every
+# quarantine up to PROXY_QUARANTINE_MAX, and evict it after too many
+PROXY_MAX_FAILURES = 3
+PROXY_QUARANTINE = 60
+PROXY_QUARANTINE_MAX = 3600
+PROXY_MAX_QUARANTINES = 5
+
+# requeue ban and verification pages instead of passing them to callbacks,
+# see `BanDetectionMiddleware`
+BAN_DETECTION_ENABLED = True
+# redirected to or served from these urls
+BAN_URL_PATTERNS = ['verify.meituan.com', '/verify', 'captcha']
+BAN_HTTP_CODES = [403, 429]
+# callback -> text which every good page of it has
+BAN_REQUIRED_MARKERS = {'detail': 'basic-info'}
+# real pages are tens of kilobytes
+BAN_MIN_BODY_SIZE = 1024
+BAN_MAX_RETRIES = 3
+# download delay of a banned slot is doubled up to the max, and multiplied
+# by the recovery on good responses
+BAN_BACKOFF_MAX_DELAY = 60
+BAN_BACKOFF_RECOVERY = 0.9
+
+# store every good response compressed in segment files, to re-extract
+# items offline with `scrapy reparse <spider>`, see `ArchiveMiddleware`.
+# The archive is never pruned, it grows with every crawl
+ARCHIVE_ENABLED = False
+ARCHIVE_DIR = 'archive'
+# bytes, a new segment file is started after this size
+ARCHIVE_SEGMENT_SIZE = 256 * 1024 * 1024
+# 'zstd' needs zstandard, and falls back to 'zlib' without it
+ARCHIVE_CODEC = 'zstd'
+ARCHIVE_COMPRESSION_LEVEL = 3
 
 BOT_NAME = 'dianping_crawler'
 MONGO_DATABASE = 'dianping'
 
+# how to run blocking mongodb calls:
+#   'sync': in the reactor thread
+#   'thread': in a dedicated thread pool, return Deferreds
+STORAGE_BACKEND = 'thread'
+STORAGE_THREADPOOL_SIZE = 10
+
+# check child requests with one query per batch, and buffer writes of the
+# delta collection, which are flushed by size, by timer and on spider closed
+DELTA_BATCH_ENABLED = True
+DELTA_FLUSH_SIZE = 500
+# seconds
+DELTA_FLUSH_INTERVAL = 5
+
+# drop already finished requests without asking mongodb. The bloom filter
+# grows as needed and costs ~3 bytes per finished request for an error
+# rate of 0.0001, i.e. about 1 of 10000 unseen requests is dropped wrongly.
+# It's warmed from the delta collection, or from the snapshot which is
+# dumped on spider closed, if the snapshot is of the same delta collection
+DELTA_SEEN_FILTER_ENABLED = True
+DELTA_SEEN_FILTER_CAPACITY = 1000000
+DELTA_SEEN_FILTER_ERROR_RATE = 0.0001
+DELTA_SEEN_FILTER_PATH = 'delta_seen.bloom'
+
+# unfinished requests are resumed lazily, by chunks of this size
+DELTA_RESUME_CHUNK_SIZE = 1000
+
+# share one delta collection between several nodes, e.g. on one box:
+#   scrapy crawl food -s DELTA_DISTRIBUTED=1 -s NODE_INDEX=0 -s NODE_COUNT=2
+#   scrapy crawl food -s DELTA_DISTRIBUTED=1 -s NODE_INDEX=1 -s NODE_COUNT=2
+# Nodes claim batches of unfinished entries with leases, which are extended
+# by heartbeat and reclaimed by others when expired. Seeds are partitioned
+# by NODE_INDEX and NODE_COUNT, an idle node waits for a lease ttl for
+# entries of other nodes, see `benchmarks/distributed.py`
+DELTA_DISTRIBUTED = False
+# default to "hostname-pid"
+NODE_ID = None
+NODE_INDEX = 0
+NODE_COUNT = 1
+# seconds
+DELTA_LEASE_TTL = 300
+DELTA_HEARTBEAT_INTERVAL = 60
+DELTA_LEASE_BATCH = 100
+# give up entries which are claimed this many times
+DELTA_LEASE_MAX_CLAIMS = 3
+
 SPIDER_MODULES = ['dianping_crawler.spiders']
 NEWSPIDER_MODULE = 'dianping_crawler.spiders'
+# `scrapy migrate_delta`, `scrapy reparse`
+COMMANDS_MODULE = 'dianping_crawler.commands'
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'dianping_crawler (+http://www.yourdomain.com)'
 
+# one sub-queue per city and stage, cities are served by weighted
+# round-robin so they make progress concurrently, see `FairPriorityQueue`
+SCHEDULER_PRIORITY_QUEUE = 'dianping_crawler.scheduler.FairPriorityQueue'
+# city id -> weight, 1 by default
+SCHEDULER_CITY_WEIGHTS = {}
+# priority -> weight of stages within a city, e.g. {100: 1, 75: 1, 50: 1, 0: 4};
+# empty serves higher priorities first
+SCHEDULER_STAGE_WEIGHTS = {}
+# with JOBDIR, requests are queued on disk in the compact format of delta,
+# so memory stays bounded however many cities are crawled
+SCHEDULER_DISK_QUEUE = 'dianping_crawler.scheduler.CompactDiskQueue'
+
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = False
 
@@ -65,13 +191,29 @@ DEFAULT_REQUEST_HEADERS = {
 # Enable or disable spider middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
 SPIDER_MIDDLEWARES = {
-    # 'dianping_crawler.middlewares.DianpingCrawlerSpiderMiddleware': 543,
+    'dianping_crawler.middlewares.ProfilingSpiderMiddleware': 950,
+    # only enabled by `scrapy reparse`
+    'dianping_crawler.middlewares.ReplayStartMiddleware': 10,
     # 'dianping_crawler.middlewares.DeltaSpiderMiddleware': 543,
 }
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
+    # close to the engine, so only final responses are parsed
+    'dianping_crawler.middlewares.ParseOffloadMiddleware': 50,
+    # after BanDetectionMiddleware, so ban pages are not archived
+    'dianping_crawler.middlewares.ArchiveMiddleware': 60,
+    # only enabled by `scrapy reparse`, serves requests before any other
+    'dianping_crawler.middlewares.ReplayMiddleware': 1,
+    # before HttpProxyMiddleware, which reads credentials of the proxy url
+    'dianping_crawler.middlewares.ProxyPoolMiddleware': 740,
+    # sees responses and errors before ProxyPoolMiddleware and
+    # BanDetectionMiddleware requeue them
+    'dianping_crawler.middlewares.SessionPoolMiddleware': 745,
+    # responses reach it before RedirectMiddleware, so redirects to
+    # verification pages are not followed
+    'dianping_crawler.middlewares.BanDetectionMiddleware': 650,
     # 'scrapy.downloadermiddlewares.retry.RetryMiddleware': 80,
     # 'dianping_crawler.middlewares.DeltaSpiderMiddleware': 543,
     # 'scrapy.downloadermiddlewares.httpproxy.HttpProxyMiddleware': 750,
@@ -80,15 +222,53 @@ DOWNLOADER_MIDDLEWARES = {
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
-   'dianping_crawler.pipelines.DianpingCrawlerPipeline': 300,
+   # 'dianping_crawler.pipelines.DianpingCrawlerPipeline': 300,
+   'dianping_crawler.pipelines.BufferedMongoPipeline': 300,
 }
+# BufferedMongoPipeline flushes when a collection has `PIPELINE_BUFFER_SIZE`
+# items, or every `PIPELINE_FLUSH_INTERVAL` seconds
+PIPELINE_BUFFER_SIZE = 100
+PIPELINE_FLUSH_INTERVAL = 10
+# replace existing items instead of counting them as duplicated
+PIPELINE_UPSERT = False
+# store a hash of item fields with last_seen and last_changed, unchanged
+# items only get their timestamps touched instead of a rewrite
+PIPELINE_CHANGE_DETECTION = True
+# days until shops are recrawled, halved when a shop changed and grown by
+# half when not, within min and max
+RECRAWL_INTERVAL = 7
+RECRAWL_MIN_INTERVAL = 1
+RECRAWL_MAX_INTERVAL = 60
+# start food spider with shops due for recrawl, instead of city listings
+FOOD_RECRAWL = False
+# drop shops and reviews of missing or malformed fields, counted in stats
+# as `item/invalid/<field>`
+ITEM_VALIDATION = True
+# 'cartesian' crawls listings of every category in every area, 'adaptive'
+# starts from listings of categories, and only splits them by areas, then
+# sub-areas or sub-categories, when they have more shops than
+# LISTING_PAGE_LIMIT pages of LISTING_PAGE_SIZE
+REGION_SPLIT = 'adaptive'
+LISTING_PAGE_LIMIT = 50
+LISTING_PAGE_SIZE = 15
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
 EXTENSIONS = {
    'scrapy.extensions.telnet.TelnetConsole': None,
+   'dianping_crawler.extensions.CrawlProfiler': 500,
 }
 
+# per-callback time, parse time, response bytes and mongodb latencies in
+# stats, and in a JSON snapshot written periodically
+PROFILE_ENABLED = True
+PROFILE_SNAPSHOT_PATH = 'profile.json'
+# seconds
+PROFILE_SNAPSHOT_INTERVAL = 60
+# sample stacks every this many seconds of CPU time, 0 to disable
+PROFILE_SAMPLING_INTERVAL = 0
+PROFILE_SAMPLING_PATH = 'profile.stacks'
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
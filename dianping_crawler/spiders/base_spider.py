@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
+import time
+import zlib
 import scrapy
 import logging
-from datetime import datetime
 try:
     from urlparse import urljoin
 except ImportError:
     from urllib.parse import urljoin
+from . import extractors
 from .delta_helper import DeltaHelper
 
 
@@ -17,20 +19,37 @@ class BaseSpider(scrapy.Spider):
         self.delta = DeltaHelper(self)
         self.delta.connect_db()
 
-    def extract_int(self, text):
-        i = -1
-        for i in range(len(text)):
-            if text[i].isdigit():
-                break
-        j = len(text) if i >= 0 else -1
-        for j in range(i + 1, len(text)):
-            if not text[j].isdigit():
-                break
+    # scrapy 2.13+ starts spiders by `start` instead of `start_requests`
+    async def start(self):
+        for request in self.start_requests():
+            yield request
+
+    # partition of work in distributed mode, see `DELTA_DISTRIBUTED`
+    def is_own_partition(self, key):
+        count = self.settings.getint('NODE_COUNT', 1)
+        index = self.settings.getint('NODE_INDEX', 0)
+        return zlib.crc32(str(key).encode('utf-8')) % count == index
+
+    # 'pyquery', or 'lxml' for precompiled XPaths of `extractors`
+    @property
+    def parser_engine(self):
+        return self.settings.get('PARSER_ENGINE', 'pyquery')
+
+    # time of `func` as `profile/<stage>/{count,seconds}`, recorded when
+    # PROFILE_ENABLED
+    def timed(self, stage, func, *args):
+        if not self.settings.getbool('PROFILE_ENABLED'):
+            return func(*args)
+        start = time.perf_counter()
         try:
-            return int(text[i:j])
-        except ValueError:
-            self.logger.warning('cannot extract integer from "%s"', text)
-            return None
+            return func(*args)
+        finally:
+            prefix = 'profile/{}/'.format(stage)
+            self.crawler.stats.inc_value(prefix + 'count')
+            self.crawler.stats.inc_value(prefix + 'seconds', time.perf_counter() - start)
+
+    def extract_int(self, text):
+        return extractors.extract_int(text)
 
     def aa2urls(self, aa):
         urls = []
@@ -49,11 +68,4 @@ class BaseSpider(scrapy.Spider):
         return None
 
     def text2date(self, date):
-        if date.count('-') == 1:
-            date = '{}-{}'.format(datetime.now().year % 100, date)
-        try:
-            date = datetime.strptime(date, '%y-%m-%d')
-        except ValueError:
-            self.logger.warning('not a valid date: "%s"', date)
-            date = None
-        return date
+        return extractors.text2date(date)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import math
+import pickle
+import hashlib
+
+
+class BloomFilter(object):
+    """ Plain bloom filter with a fixed capacity.
+
+    Uses `k` bit positions derived from one md5 digest by double hashing.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+        # m = -n * ln(p) / ln(2)^2, k = m / n * ln(2)
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def positions(self, key):
+        if not isinstance(key, bytes):
+            key = str(key).encode('utf-8')
+        digest = hashlib.md5(key).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self.positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    # return True if key is new
+    def add(self, key):
+        bits = self.bits
+        is_new = False
+        for pos in self.positions(key):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                is_new = True
+        if is_new:
+            self.count += 1
+        return is_new
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+
+class ScalableBloomFilter(object):
+    """ Bloom filter which grows when it's full (Almeida et al., 2007).
+
+    Each new slice has `GROWTH` times the capacity of the previous one and
+    an error rate tightened by `TIGHTENING`, so the false positive
+    probability of the whole filter stays below `error_rate` no matter
+    how many keys are added. Memory is about `-ln(error_rate) / ln(2)^2`
+    bits per key, e.g. ~1.8 bytes per key for an error rate of 0.001.
+    """
+    GROWTH = 2
+    TIGHTENING = 0.5
+    # what the keys belong to, e.g. the collection they are read from, set
+    # by the owner and kept in snapshots
+    identity = None
+
+    def __init__(self, initial_capacity=100000, error_rate=0.001):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.filters = []
+
+    def __contains__(self, key):
+        for f in reversed(self.filters):
+            if key in f:
+                return True
+        return False
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    def add(self, key):
+        if key in self:
+            return False
+        if not self.filters or self.filters[-1].is_full():
+            i = len(self.filters)
+            capacity = self.initial_capacity * self.GROWTH ** i
+            # sum of all slices' error rates converges to `error_rate`
+            error_rate = self.error_rate * (1 - self.TIGHTENING) * self.TIGHTENING ** i
+            self.filters.append(BloomFilter(capacity, error_rate))
+        return self.filters[-1].add(key)
+
+    @property
+    def nbytes(self):
+        return sum(len(f.bits) for f in self.filters)
+
+    def dump(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            obj = pickle.load(f)
+        if not isinstance(obj, cls):
+            raise ValueError('not a bloom filter snapshot: {}'.format(path))
+        return obj
@@ -4,51 +4,326 @@
 #
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
+import os
 import bson
+import socket
+import hashlib
+import itertools
 import scrapy
 import pymongo
 import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.http import Headers
+from twisted.internet import defer, task
+from ..context import CrawlContext
+from ..storage import get_storage
+from .bloom_filter import ScalableBloomFilter
 
 
 class DeltaHelper(object):
     item = {
-        "_id": "GET https://example.com",
+        # fingerprint of "GET https://example.com", BSON binary
+        "_id": b'\x9a\x1f...',
         "finished": True,
         # request fields
         "url": "https://example.com",
         "method": "GET",
         "callback": "self.func_name",
         "errback": "self.func_name",
+        "priority": 0,
         "meta": {},
     }
+    # fields stored for `request_deserialize`, None values are omitted
+    FIELDS = ('url', 'method', 'callback', 'errback', 'priority', 'meta', 'headers')
+    # fields of `request.meta` set by spiders, scrapy internals such as
+    # `depth` or `download_slot` are not stored. Fields of `context` are
+    # stored flat, like older entries which had them copied into meta
+    META_FIELDS = ('city_id', 'city_name', 'shop_id', 'shop_url', 'tag', 'tags',
+                   'newest_review_id', 'max_review_id')
+    FINGERPRINT_SIZE = 16
+    RESUME_INDEX = [
+        ('finished', pymongo.ASCENDING),
+        ('priority', pymongo.DESCENDING),
+        ('_id', pymongo.ASCENDING),
+    ]
+    # claims are sorted by RESUME_INDEX, this one is for heartbeats
+    LEASE_INDEX = [
+        ('lease_owner', pymongo.ASCENDING),
+        ('finished', pymongo.ASCENDING),
+    ]
+    # _id of the marker entry of the delta collection, which holds a random
+    # epoch created with the collection, so a dropped or reset collection
+    # gets a new one
+    EPOCH_ID = 'epoch'
     logger = logging.getLogger(__name__)
 
     def __init__(self, spider):
         self.spider = spider
+        self.storage = get_storage(spider.crawler)
         # connect to mongodb
         self.mongo_uri = spider.settings.get('MONGO_URI')
         self.db_name = spider.settings.get('MONGO_DATABASE', 'delta')
+        # batch mode: one `$in` query per batch of requests, writes are
+        # buffered and flushed with one unordered `bulk_write`
+        self.batch_enabled = spider.settings.getbool('DELTA_BATCH_ENABLED', False)
+        self.flush_size = spider.settings.getint('DELTA_FLUSH_SIZE', 500)
+        self.flush_interval = spider.settings.getfloat('DELTA_FLUSH_INTERVAL', 5)
+        # _id -> serialized request which is not written to db yet
+        self.pending = OrderedDict()
+        self.flush_task = None
+        # in-process set of finished request ids, a false positive drops an
+        # unfinished request, so keep the error rate small
+        self.seen_enabled = spider.settings.getbool('DELTA_SEEN_FILTER_ENABLED', False)
+        self.seen_capacity = spider.settings.getint('DELTA_SEEN_FILTER_CAPACITY', 1000000)
+        self.seen_error_rate = spider.settings.getfloat('DELTA_SEEN_FILTER_ERROR_RATE', 0.0001)
+        self.seen_path = spider.settings.get('DELTA_SEEN_FILTER_PATH')
+        self.seen = None
+        self.resume_chunk_size = spider.settings.getint('DELTA_RESUME_CHUNK_SIZE', 1000)
+        # rebuilt by DefaultHeadersMiddleware, so not stored
+        self.default_headers = Headers(spider.settings.getdict('DEFAULT_REQUEST_HEADERS'))
+        # distributed mode: nodes claim unfinished entries with leases, which
+        # are extended by heartbeat and reclaimed by others when expired
+        self.distributed = spider.settings.getbool('DELTA_DISTRIBUTED', False)
+        self.node_id = (spider.settings.get('NODE_ID') or
+                        '{}-{}'.format(socket.gethostname(), os.getpid()))
+        self.lease_ttl = timedelta(seconds=spider.settings.getint('DELTA_LEASE_TTL', 300))
+        self.lease_batch = spider.settings.getint('DELTA_LEASE_BATCH', 100)
+        self.lease_max_claims = spider.settings.getint('DELTA_LEASE_MAX_CLAIMS', 3)
+        self.heartbeat_interval = spider.settings.getfloat('DELTA_HEARTBEAT_INTERVAL', 60)
+        self.heartbeat_task = None
+        self.opened = None
+        # for `scrapy reparse`: nothing is written, callbacks follow no
+        # request and nothing is resumed
+        self.read_only = spider.settings.getbool('DELTA_READ_ONLY', False)
 
     def connect_db(self):
         self.db_client = pymongo.MongoClient(self.mongo_uri)
         self.db_collection = self.db_client[self.db_name]['delta']
+        self.spider.crawler.signals.connect(self.spider_closed,
+                                            signal=signals.spider_closed)
+        if self.read_only:
+            return
+        self.db_collection.create_index(self.RESUME_INDEX)
+
+        if self.batch_enabled:
+            self.flush_task = task.LoopingCall(self.flush)
+            self.flush_task.start(self.flush_interval, now=False)
+        if self.seen_enabled:
+            self.load_seen_filter()
+        if self.distributed:
+            self.db_collection.create_index(self.LEASE_INDEX)
+            self.opened = datetime.utcnow()
+            self.heartbeat_task = task.LoopingCall(self.heartbeat)
+            self.heartbeat_task.start(self.heartbeat_interval, now=False)
+            self.spider.crawler.signals.connect(self.spider_idle,
+                                                signal=signals.spider_idle)
+
+    def spider_closed(self, spider):
+        for t in (self.flush_task, self.heartbeat_task):
+            if t and t.running:
+                t.stop()
+        self.flush()
+        if self.seen is not None and self.seen_path:
+            self.seen.dump(self.seen_path)
+            self.logger.info('Dump %d finished ids to %s', len(self.seen), self.seen_path)
+        return self.storage.drain()
+
+    # the filter only has to be a subset of finished ids, so an outdated
+    # snapshot is safe: entries finished after it just go to mongodb. A
+    # snapshot of another collection is not, e.g. after the delta collection
+    # is dropped or MONGO_URI changes, so it's only used if its identity is
+    # the one of the current collection
+    def load_seen_filter(self):
+        identity = self.collection_identity()
+        if self.seen_path and os.path.exists(self.seen_path):
+            seen = ScalableBloomFilter.load(self.seen_path)
+            if seen.identity == identity:
+                self.seen = seen
+                self.logger.info('Load %d finished ids from %s', len(self.seen), self.seen_path)
+                return
+            self.logger.warning('Snapshot %s is of another delta collection, rebuild it from db',
+                                self.seen_path)
 
+        self.seen = ScalableBloomFilter(self.seen_capacity, self.seen_error_rate)
+        self.seen.identity = identity
+        cursor = self.db_collection.find({'finished': True}, {'_id': 1}).batch_size(10000)
+        for entry in cursor:
+            self.seen.add(entry['_id'])
+        self.logger.info('Load %d finished ids from db', len(self.seen))
+
+    # (database, collection, epoch) of the delta collection, the epoch is
+    # created by the first node which asks for it
+    def collection_identity(self):
+        cond = {'_id': self.EPOCH_ID}
+        self.db_collection.update_one(cond, {'$setOnInsert': {'epoch': bson.ObjectId()}},
+                                      upsert=True)
+        epoch = self.db_collection.find_one(cond)['epoch']
+        return (self.db_name, self.db_collection.name, str(epoch))
+
+    def is_seen(self, _id):
+        return self.seen is not None and _id in self.seen
+
+    # stream unfinished requests in chunks of `resume_chunk_size` with
+    # keyset pagination, a chunk is fetched only when the previous one is
+    # consumed, so memory stays flat however large the backlog is
     def fetch_unfinished_requests(self):
+        if self.read_only:
+            return
+        if self.distributed:
+            yield from self.claim_unfinished_requests()
+            return
+
         cond = {'finished': False}
-        entries = self.db_collection.find(cond)
+        sort = [('priority', pymongo.DESCENDING), ('_id', pymongo.ASCENDING)]
+        last = None
 
-        def gen_request(serialized):
-            if serialized:
+        while True:
+            query = dict(cond)
+            if last is not None:
+                query['$or'] = [
+                    {'priority': {'$lt': last['priority']}},
+                    {'priority': last['priority'], '_id': {'$gt': last['_id']}},
+                ]
+            entries = list(self.db_collection.find(query)
+                           .sort(sort)
+                           .hint(self.RESUME_INDEX)
+                           .limit(self.resume_chunk_size))
+            if not entries:
+                return
+
+            for serialized in entries:
                 self.logger.debug("Add %s", serialized['url'])
-                return self.request_deserialize(self.spider, serialized)
-            else:
-                return None
+                yield self.request_deserialize(self.spider, serialized)
+            last = entries[-1]
 
-        return filter(bool, map(gen_request, entries))
+    # claim batches of claimable entries lazily until nothing is left
+    def claim_unfinished_requests(self):
+        while True:
+            requests = self.claim_requests(self.lease_batch)
+            if not requests:
+                return
+            yield from requests
+
+    def claimable_cond(self, now):
+        return {
+            'finished': False,
+            # not leased, or lease expired
+            'lease_expires': {'$not': {'$gt': now}},
+            'lease_claims': {'$not': {'$gte': self.lease_max_claims}},
+        }
+
+    def claim_requests(self, n):
+        requests = []
+        for _ in range(n):
+            now = datetime.utcnow()
+            serialized = self.db_collection.find_one_and_update(
+                self.claimable_cond(now),
+                {
+                    '$set': {'lease_owner': self.node_id, 'lease_expires': now + self.lease_ttl},
+                    '$inc': {'lease_claims': 1},
+                },
+                sort=[('priority', pymongo.DESCENDING)],
+                hint=self.RESUME_INDEX,
+            )
+            if serialized is None:
+                break
+            self.logger.debug("Claim %s", serialized['url'])
+            requests.append(self.request_deserialize(self.spider, serialized))
+        return requests
+
+    # seeds are not entries of delta, so a node which dies before its seeds
+    # are crawled would lose its whole partition. In distributed mode they
+    # are written as entries leased by this node before they are crawled,
+    # by chunks of `lease_batch`, for others to reclaim. Existing entries
+    # are left alone and seeds are crawled anyway, like in single node mode
+    def lease_seeds(self, requests):
+        requests = iter(requests)
+        if not self.distributed or self.read_only:
+            yield from requests
+            return
+
+        while True:
+            chunk = list(itertools.islice(requests, self.lease_batch))
+            if not chunk:
+                return
+            operations = []
+            for request in chunk:
+                serialized = self.request_serialize(request, self.default_headers)
+                serialized['finished'] = False
+                serialized.update(self.lease_fields())
+                cond = {'_id': serialized.pop('_id')}
+                operations.append(UpdateOne(cond, {'$setOnInsert': serialized}, upsert=True))
+            self.bulk_write(operations)
+            yield from chunk
+
+    # new entries are leased by the node which found them
+    def lease_fields(self):
+        if not self.distributed:
+            return {}
+        return {
+            'lease_owner': self.node_id,
+            'lease_expires': datetime.utcnow() + self.lease_ttl,
+            'lease_claims': 1,
+        }
+
+    def heartbeat(self):
+        cond = {'lease_owner': self.node_id, 'finished': False}
+        value = {'$set': {'lease_expires': datetime.utcnow() + self.lease_ttl}}
+        d = self.storage.call(self.db_collection.update_many, cond, value)
+        d.addErrback(self.storage.log_error, 'heartbeat')
+        return d
+
+    def spider_idle(self, spider):
+        # wait until buffered writes are done
+        if self.pending or self.storage.running:
+            self.flush()
+            raise DontCloseSpider
+
+        # nothing is in flight, so unfinished entries leased by this node
+        # are failed ones, release them for anyone to retry
+        now = datetime.utcnow()
+        cond = {'lease_owner': self.node_id, 'finished': False}
+        self.db_collection.update_many(cond, {'$set': {'lease_expires': now}})
+
+        requests = self.claim_requests(self.lease_batch)
+        for request in requests:
+            # released entries of this node were already seen by its dupefilter
+            self.spider.crawler.engine.crawl(request.replace(dont_filter=True))
+        if requests:
+            raise DontCloseSpider
+
+        # wait for entries leased by other nodes, they may be reclaimed
+        cond = {
+            'finished': False,
+            'lease_claims': {'$not': {'$gte': self.lease_max_claims}},
+        }
+        if self.db_collection.find_one(cond, {'_id': 1}):
+            raise DontCloseSpider
+
+        # a node without seeds has nothing to claim until other nodes
+        # found entries, so wait for them to start for a lease ttl
+        if datetime.utcnow() - self.opened < self.lease_ttl:
+            raise DontCloseSpider
 
     def check_request(self, request):
-        serialized = self.request_serialize(request)
+        if self.read_only:
+            return None
+        if self.batch_enabled:
+            checked = self.check_requests_batch([request])
+            return checked[0] if checked else None
+
+        serialized = self.request_serialize(request, self.default_headers)
         serialized['finished'] = False
+        serialized.update(self.lease_fields())
+        if self.is_seen(serialized['_id']):
+            self.logger.debug("Ignore %s", request.url)
+            return None
+
         cond = {'_id': self.serialized_request_id(serialized)}
         result = self.db_collection.find_one(cond)
 
@@ -56,88 +331,180 @@ class DeltaHelper(object):
             self.logger.debug("Ignore %s", request.url)
             return None
         elif not result:
-            try:
-                self.db_collection.insert_one(serialized)
-                return request
-            except Exception as e:
-                # DEBUG:
-                import ipdb; ipdb.set_trace()
-                raise e
-                self.logger.error('%s', serialized)
+            d = self.storage.call(self.db_collection.insert_one, serialized)
+            # it may be marked as finished before inserted
+            d.addErrback(lambda f: f.trap(DuplicateKeyError))
+            d.addErrback(self.storage.log_error, 'insert delta')
+            return request
 
     def check_requests(self, requests, hurry=False):
+        if self.read_only:
+            return []
+        if self.batch_enabled:
+            return self.check_requests_batch(requests)
+
         checked = filter(bool, map(self.check_request, requests))
         if hurry:
             return list(checked)
         else:
             return checked
 
+    # same semantic as `check_request`, but only costs one query per batch
+    def check_requests_batch(self, requests):
+        batch = OrderedDict()
+        for request in requests:
+            if not request:
+                continue
+            serialized = self.request_serialize(request, self.default_headers)
+            serialized['finished'] = False
+            serialized.update(self.lease_fields())
+            _id = serialized['_id']
+            # already finished, pending in buffer, or duplicated in this batch
+            if self.is_seen(_id) or _id in self.pending or _id in batch:
+                self.logger.debug("Ignore %s", request.url)
+                continue
+            batch[_id] = (request, serialized)
+
+        if not batch:
+            return []
+
+        cond = {'_id': {'$in': list(batch.keys())}}
+        for result in self.db_collection.find(cond, {'_id': 1}):
+            request, _ = batch.pop(result['_id'])
+            self.logger.debug("Ignore %s", request.url)
+
+        checked = []
+        for _id, (request, serialized) in batch.items():
+            self.pending[_id] = serialized
+            checked.append(request)
+
+        self.flush_if_full()
+        return checked
+
     def mark_as_finished(self, request):
-        if not request:
+        if not request or self.read_only:
             return
-        serialized = self.request_serialize(request)
-        serialized['finished'] = True
-        cond = {'_id': self.serialized_request_id(serialized)}
-        value = {'$set': serialized}
-        self.db_collection.update_one(cond, value)
+        _id = self.request_fingerprint(request.method, request.url)
+        if self.seen is not None:
+            self.seen.add(_id)
+
+        if self.batch_enabled:
+            if _id in self.pending:
+                self.pending[_id]['finished'] = True
+            else:
+                self.pending[_id] = {'finished': True}
+            self.flush_if_full()
+            return
+
+        # upsert, the insertion may be still running in storage backend
+        cond = {'_id': _id}
+        value = {'$set': {'finished': True}}
+        d = self.storage.call(self.db_collection.update_one, cond, value, upsert=True)
+        d.addErrback(self.storage.log_error, 'mark as finished')
+
+    def flush_if_full(self):
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return defer.succeed(None)
+        pending, self.pending = self.pending, OrderedDict()
+
+        operations = []
+        for _id, serialized in pending.items():
+            if serialized['finished']:
+                # finished requests are never resumed, only `finished` matters
+                cond = {'_id': _id}
+                value = {'$set': {'finished': True}}
+                operations.append(UpdateOne(cond, value, upsert=True))
+            else:
+                operations.append(InsertOne(serialized))
+
+        d = self.storage.call(self.bulk_write, operations)
+        d.addErrback(self.storage.log_error, 'flush delta')
+        return d
+
+    def bulk_write(self, operations):
+        try:
+            self.db_collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # entries inserted by others in the meantime are fine
+            errors = [err for err in e.details['writeErrors'] if err['code'] != 11000]
+            if errors:
+                self.logger.error('flush delta failed: %s', errors)
 
     @classmethod
     def serialized_request_id(cls, serialized):
-        return '{} {}'.format(serialized['method'], serialized['url'])
+        return cls.request_fingerprint(serialized['method'], serialized['url'])
 
-    # modify obj
+    # fixed-size binary key instead of the "METHOD URL" string. Plain bytes,
+    # which are stored as BSON binary and read back as bytes, while a
+    # `bson.Binary` never equals the bytes read back, e.g. `_id`s of `$in`
     @classmethod
-    def object_serialize(cls, obj):
-        if isinstance(obj, scrapy.http.Request):
-            obj = cls.request_serialize(obj)
-        if isinstance(obj, scrapy.http.Headers):
-            obj = dict(obj)
-
-        if isinstance(obj, dict):
-            for k in obj.keys():
-                v = cls.object_serialize(obj.pop(k))
-                if isinstance(k, bytes):
-                    k = str(k, 'utf-8')
-                obj[k] = v
-        elif isinstance(obj, list):
-            for i in range(len(obj)):
-                obj[i] = cls.object_serialize(obj[i])
-        elif isinstance(obj, bytes):
-            return bson.Binary(obj)
-
-        return obj
+    def request_fingerprint(cls, method, url):
+        key = '{} {}'.format(method, url).encode('utf-8')
+        return hashlib.sha1(key).digest()[:cls.FINGERPRINT_SIZE]
 
+    # keep only the fields needed to rebuild the request
     @classmethod
-    def request_serialize(cls, request):
-        serialized = {}
+    def compact_serialized(cls, serialized):
+        compacted = {k: serialized[k] for k in cls.FIELDS if serialized.get(k) is not None}
+        compacted['meta'] = cls.meta_serialize(compacted.get('meta', {}))
+        compacted['_id'] = cls.serialized_request_id(compacted)
+        compacted['finished'] = serialized.get('finished', False)
+        return compacted
 
-        for k, v in request.__dict__.items():
-            if k.startswith('_'):
-                k = k.lstrip('_')
-            if callable(v):
-                v = v.__name__
-            serialized[k] = v
+    # request is not modified
+    @classmethod
+    def request_serialize(cls, request, default_headers=None):
+        serialized = {
+            'url': request.url,
+            'method': request.method,
+            'callback': cls.callable_name(request.callback),
+            'errback': cls.callable_name(request.errback),
+            'priority': request.priority,
+            'meta': request.meta,
+            'headers': cls.headers_serialize(request.headers, default_headers),
+        }
+        return cls.compact_serialized(serialized)
 
-        serialized['_id'] = cls.serialized_request_id(serialized)
-        serialized['headers'] = cls.object_serialize(serialized['headers'])
+    @classmethod
+    def callable_name(cls, func):
+        return func.__name__ if callable(func) else func
 
-        return serialized
+    @classmethod
+    def headers_serialize(cls, headers, default_headers=None):
+        serialized = {}
+        for k, values in headers.items():
+            if default_headers is not None and default_headers.getlist(k) == values:
+                continue
+            serialized[k.decode('latin1')] = [v.decode('latin1') for v in values]
+        return serialized or None
 
     @classmethod
     def request_deserialize(cls, spider, serialized):
-        serialized = dict(serialized)
-
-        def safe_set_value(key):
-            if serialized.get(key) is not None:
-                serialized[key] = spider.__getattribute__(serialized[key])
-
-        def safe_del_key(key):
-            if serialized.get(key) is not None:
-                del serialized[key]
+        kwargs = {k: serialized[k] for k in cls.FIELDS if serialized.get(k) is not None}
+        for key in ('callback', 'errback'):
+            if key in kwargs:
+                kwargs[key] = getattr(spider, kwargs[key])
+        if 'meta' in kwargs:
+            kwargs['meta'] = cls.meta_deserialize(kwargs['meta'])
+        return scrapy.Request(**kwargs)
 
-        safe_set_value('callback')
-        safe_set_value('errback')
-        safe_del_key('_id')
-        safe_del_key('finished')
+    @classmethod
+    def meta_serialize(cls, meta):
+        serialized = {k: meta[k] for k in cls.META_FIELDS if k in meta}
+        context = meta.get('context')
+        if context is not None:
+            serialized.update(context.to_dict())
+        return serialized
 
-        return scrapy.Request(**serialized)
+    # fields of the context go back into `context`
+    @classmethod
+    def meta_deserialize(cls, serialized):
+        meta = {k: v for k, v in serialized.items() if k not in CrawlContext.__slots__}
+        context = CrawlContext.from_dict(serialized)
+        if context is not None:
+            meta['context'] = context
+        return meta
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+# Extract fields of shop detail and review pages with lxml
+#
+# Pages are parsed once, and every field is read by a precompiled XPath.
+# Functions here are pure: they take the page and return plain dicts, the
+# same dicts as the PyQuery callbacks of spiders.
+import re
+import json
+import emoji
+import logging
+from datetime import datetime
+from lxml import etree, html
+
+logger = logging.getLogger(__name__)
+
+WORDS_MAP = {
+    '口味': 'taste',
+    '环境': 'environment',
+    '服务': 'service',
+}
+# same as PyQuery: text of inline elements is joined, block elements and
+# `<br>` are separated by newlines
+INLINE_TAGS = {
+    'a', 'abbr', 'acronym', 'b', 'bdo', 'big', 'button', 'cite',
+    'code', 'dfn', 'em', 'i', 'img', 'input', 'kbd', 'label', 'map',
+    'object', 'q', 'samp', 'script', 'select', 'small', 'span', 'strong',
+    'sub', 'sup', 'textarea', 'time', 'tt', 'var',
+}
+WHITESPACE = '\x20\x09\x0C\u200B\x0A\x0D'
+WHITESPACE_RE = re.compile('[{}]+'.format(WHITESPACE))
+# characters which are not part of any emoji, such as ASCII, CJK and their
+# punctuations, text made of them only skips `emoji.demojize`
+NO_EMOJI = ('\x00-\x7f\u00a0-\u00a8\u00aa-\u00ad\u00af-\u00ff\u2010-\u2027'
+            '\u2030-\u203b\u3000-\u302f\u3031-\u303c\u303e\u303f\u4e00-\u9fff'
+            '\uff00-\uffef')
+MAYBE_EMOJI_RE = re.compile('[^{}]'.format(NO_EMOJI))
+
+
+def has_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+
+# class="mid-rank-stars mid-str40" -> 4
+def star_xpath(prefix):
+    return etree.XPath(".//*[contains(@class, '{}')]/@class".format(prefix))
+
+
+def star_regex(prefix):
+    return re.compile(r'(?:^|\s){}(\d+)(?:\s|$)'.format(re.escape(prefix)))
+
+
+TEXT_NODES = etree.XPath('text()')
+
+SHOP_XPATHS = {
+    'basic_info': etree.XPath("//*[@id='basic-info']"),
+    'brief_info': etree.XPath(".//*[{}]".format(has_class('brief-info'))),
+    # text nodes of the shop name, without its children like "branch"
+    'shop_name': etree.XPath(".//*[{}]".format(has_class('shop-name'))),
+    'address': etree.XPath(".//*[{}]//*[{}]".format(has_class('address'), has_class('item'))),
+    'telephones': etree.XPath(".//*[{}]//*[{}]".format(has_class('tel'), has_class('item'))),
+    'average_price': etree.XPath(".//*[@id='avgPriceTitle']"),
+    'average_score': star_xpath('mid-str'),
+    'score': etree.XPath(".//*[@id='comment_score']//*[{}]".format(has_class('item'))),
+}
+SHOP_STAR_RE = star_regex('mid-str')
+
+REVIEW_XPATHS = {
+    'comments': etree.XPath("//*[{}]/ul/li".format(has_class('comment-list'))),
+    'user_id': etree.XPath(".//div[{}]/a/@user-id".format(has_class('pic'))),
+    'user_info': etree.XPath(".//div[{}]//div[{}]".format(has_class('content'), has_class('user-info'))),
+    'average_score': star_xpath('irr-star'),
+    'date': etree.XPath(".//div[{}]/div[{}]/span[{}]".format(
+        has_class('content'), has_class('misc-info'), has_class('time'))),
+    'score': etree.XPath(".//*[{}]".format(has_class('rst'))),
+    'description': etree.XPath(".//div[{}]/div[{}]/div".format(
+        has_class('content'), has_class('comment-txt'))),
+}
+REVIEW_STAR_RE = star_regex('irr-star')
+REVIEW_NEXT_PAGE = etree.XPath("//*[{}]//*[{}]/@href".format(has_class('Pages'), has_class('NextPage')))
+
+TAGGED_REVIEW_XPATHS = {
+    'comments': etree.XPath("//li[{}]".format(has_class('comment-item'))),
+    'user_id': etree.XPath(".//a[{}]/@data-user-id".format(has_class('avatar'))),
+    'average_score': star_xpath('sml-str'),
+    'score': etree.XPath(".//*[{}]//*[{}]".format(has_class('shop-info'), has_class('item'))),
+    'date': etree.XPath(".//*[{}]".format(has_class('time'))),
+    'description': etree.XPath(".//*[{}]".format(has_class('desc'))),
+    'tag_sentence': etree.XPath(".//*[{}]//span".format(has_class('desc'))),
+}
+TAGGED_REVIEW_STAR_RE = star_regex('sml-str')
+
+
+# `body` is str, or bytes in `encoding`
+def parse_html(body, encoding='utf-8'):
+    if isinstance(body, bytes):
+        parser = html.HTMLParser(encoding=encoding)
+        return html.document_fromstring(body, parser=parser)
+    return html.document_fromstring(body)
+
+
+def squash(text):
+    return WHITESPACE_RE.sub(' ', text).strip(WHITESPACE)
+
+
+def element_text(element):
+    lines, parts = [], []
+
+    def flush():
+        line = squash(''.join(parts))
+        if line:
+            lines.append(line)
+        parts[:] = []
+
+    def walk(e):
+        # comments and processing instructions
+        if not isinstance(e.tag, str):
+            return
+        block = e.tag not in INLINE_TAGS
+        if block:
+            flush()
+        if e.text:
+            parts.append(e.text)
+        for child in e:
+            walk(child)
+            if child.tail:
+                parts.append(child.tail)
+        if block:
+            flush()
+
+    walk(element)
+    flush()
+    return '\n'.join(lines)
+
+
+# same as `PyQuery.text()` of a list of elements
+def text(elements):
+    return ' '.join(element_text(e) for e in elements)
+
+
+def first(values, default=None):
+    return values[0] if values else default
+
+
+# index of the smallest star class, same as `BaseSpider.find_classes_exists`
+def star_score(classes, regex):
+    scores = []
+    for cls in classes:
+        for m in regex.finditer(cls):
+            value = int(m.group(1))
+            if value % 10 == 0 and 0 <= value <= 50:
+                scores.append(value // 10)
+    return min(scores) if scores else None
+
+
+# emoji to their names, e.g. 👍 -> :thumbs_up:
+def demojize(text):
+    if not MAYBE_EMOJI_RE.search(text):
+        return text
+    return emoji.demojize(text)
+
+
+def normalize_text(text, normalize=True):
+    return demojize(text) if normalize else text
+
+
+def extract_int(text):
+    i = -1
+    for i in range(len(text)):
+        if text[i].isdigit():
+            break
+    for j in range(i + 1, len(text)):
+        if not text[j].isdigit():
+            break
+    # digits till the end
+    else:
+        j = len(text)
+    try:
+        return int(text[i:j])
+    except ValueError:
+        logger.warning('cannot extract integer from "%s"', text)
+        return None
+
+
+def text2date(date):
+    if date.count('-') == 1:
+        date = '{}-{}'.format(datetime.now().year % 100, date)
+    try:
+        date = datetime.strptime(date, '%y-%m-%d')
+    except ValueError:
+        logger.warning('not a valid date: "%s"', date)
+        date = None
+    return date
+
+
+# fields of `FoodSpider.detail`, without `_id`, `url` and `meta`
+def extract_shop(body, encoding='utf-8'):
+    x = SHOP_XPATHS
+    doc = parse_html(body, encoding)
+    basic_info = x['basic_info'](doc)
+    brief_info = [e for b in basic_info for e in x['brief_info'](b)]
+
+    def find(xpath, roots):
+        return [e for root in roots for e in xpath(root)]
+
+    shop_name = ' '.join(squash(''.join(TEXT_NODES(e))) for e in find(x['shop_name'], basic_info))
+    address = text(find(x['address'], basic_info)).strip()
+    telephones = [span.text for span in find(x['telephones'], basic_info)]
+
+    average_price = extract_int(text(find(x['average_price'], brief_info)))
+    average_score = star_score(find(x['average_score'], brief_info), SHOP_STAR_RE)
+
+    score = {}
+    for item in find(x['score'], brief_info):
+        name, value = item.text.split('：')
+        key = WORDS_MAP[name]
+        try:
+            score[key] = float(value)
+        except ValueError:
+            logger.warning('cannot extract float from "%s"', item.text)
+
+    return {
+        'name': shop_name.strip(),
+        'address': address,
+        'telephones': telephones,
+        'average_price': average_price,
+        'average_score': average_score,
+        'score': score,
+    }
+
+
+# reviews and the href of next page of `review_all` pages, free text of
+# reviews is demojized unless `normalize` is False
+def extract_review_page(body, encoding='utf-8', normalize=True):
+    doc = parse_html(body, encoding)
+    return {
+        'reviews': extract_reviews(doc, normalize),
+        'next_page': first(REVIEW_NEXT_PAGE(doc)),
+    }
+
+
+# same as `ReviewSpider.do_parse_reviews`
+def extract_reviews(doc, normalize=True):
+    x = REVIEW_XPATHS
+    reviews = []
+
+    for li in x['comments'](doc):
+        user_info = x['user_info'](li)
+        average_score = star_score([c for u in user_info for c in x['average_score'](u)],
+                                   REVIEW_STAR_RE)
+
+        score = {}
+        for rst in (e for u in user_info for e in x['score'](u)):
+            s = (rst.text or '').strip()
+            for w in WORDS_MAP.keys():
+                if s.startswith(w):
+                    score[WORDS_MAP[w]] = extract_int(s)
+
+        reviews.append({
+            '_id': int(li.get('data-id')),
+            'user_id': int(first(x['user_id'](li))),
+            'average_score': average_score,
+            'date': text2date(text(x['date'](li))),
+            'score': score,
+            'description': normalize_text(text(x['description'](li)), normalize),
+        })
+
+    return reviews
+
+
+# same as `ReviewSpider.do_parse_tagged_reviews`, `body` is the `msg` of
+# the API response
+def extract_tagged_reviews(body, tag, encoding='utf-8', normalize=True):
+    x = TAGGED_REVIEW_XPATHS
+    doc = parse_html(body, encoding)
+    reviews = []
+
+    for li in x['comments'](doc):
+        score = {}
+        for item in x['score'](li):
+            name, value = item.text.split('：')
+            key = WORDS_MAP[name]
+            try:
+                score[key] = int(value)
+            except ValueError:
+                logger.warning('cannot extract integer from "%s"', item.text)
+
+        reviews.append({
+            '_id': int(li.get('data-id')),
+            'user_id': int(first(x['user_id'](li))),
+            'average_score': star_score(x['average_score'](li), TAGGED_REVIEW_STAR_RE),
+            'date': text2date(text(x['date'](li))),
+            'score': score,
+            'description': normalize_text(text(x['description'](li)), normalize),
+            'tag': tag,
+            'tag_sentence': normalize_text(text(x['tag_sentence'](li)), normalize),
+        })
+
+    return reviews
+
+
+# Entry points of worker processes of `ParseOffloadMiddleware`, which take
+# the raw body and return the same result as the callback would extract
+def parse_detail(body, encoding, _meta, _normalize):
+    return extract_shop(body, encoding)
+
+
+def parse_review_all(body, encoding, _meta, normalize):
+    return extract_review_page(body, encoding, normalize)
+
+
+def parse_tagged_reviews(body, encoding, meta, normalize):
+    html_content = json.loads(body.decode(encoding))['msg']
+    return extract_tagged_reviews(html_content, meta['tag'], normalize=normalize)
+
+
+WORKER_PARSERS = {
+    'detail': parse_detail,
+    'parse_review_all': parse_review_all,
+    'parse_tagged_reviews': parse_tagged_reviews,
+}
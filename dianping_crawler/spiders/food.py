@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
+import re
 import scrapy
 import logging
 import itertools
+from datetime import datetime
 from pyquery import PyQuery as pq
+from . import extractors
 from .base_spider import BaseSpider
+from ..context import CrawlContext
+from ..items import Shop
 
 
 class FoodSpider(BaseSpider):
@@ -15,6 +20,10 @@ class FoodSpider(BaseSpider):
     """
     name = "food"
     CATEGORY_ID = 10
+    # filters of a listing path by kind, e.g. g110r2580 -> g: g110, r: r2580
+    FILTER_RE = re.compile(r'([a-z]+)\d+')
+    # /search/category/2/10/g110r2580p2
+    NEXT_PAGE_RE = re.compile(r'p\d+$')
     WORDS_MAP = {
         '口味': 'taste',
         '环境': 'environment',
@@ -24,26 +33,46 @@ class FoodSpider(BaseSpider):
 
     def start_requests(self):
         self.init()
+        if self.settings.getbool('FOOD_RECRAWL'):
+            return self.delta.lease_seeds(self.recrawl_requests())
 
         def start_requests_generator():
             index_fmt = self.add_host('/search/category/{}/{}')
 
             for city_id, city_name in self.settings['CITY_IDS']:
+                if not self.is_own_partition(city_id):
+                    continue
                 url = index_fmt.format(city_id, self.CATEGORY_ID)
                 request = scrapy.Request(url, self.parse, priority=100)
-                request.meta['city_id'] = city_id
-                request.meta['city_name'] = city_name
+                request.meta['context'] = CrawlContext(city_id, city_name)
                 yield request
 
         unfinished = self.delta.fetch_unfinished_requests()
-        starts = start_requests_generator()
+        starts = self.delta.lease_seeds(start_requests_generator())
         requests = itertools.chain(unfinished, starts)
         return requests
 
+    # Shops due by `next_crawl` which is scheduled by change detection of
+    # BufferedMongoPipeline, they were finished before so bypass delta
+    def recrawl_requests(self):
+        collection = self.delta.db_client[self.delta.db_name][self.name]
+        collection.create_index('next_crawl')
+        cond = {'next_crawl': {'$lte': datetime.utcnow()}}
+        shops = collection.find(cond, {'url': 1, 'meta': 1}).sort('next_crawl', 1)
+
+        for shop in shops:
+            meta = shop['meta']
+            if not self.is_own_partition(meta['city_id']):
+                continue
+            request = scrapy.Request(shop['url'], self.detail, priority=0)
+            request.meta['context'] = CrawlContext(meta['city_id'], meta['city_name'], shop['_id'])
+            yield request
+
     # http://www.dianping.com/search/category/2/10/
     def parse(self, response):
-        city_id = response.meta['city_id']
-        d = pq(response.text)
+        context = response.meta['context']
+        city_id = context.city_id
+        d = self.timed('parse', pq, response.text)
         classfy_aa = d('#classfy a')
         area_aa = d('#J_nt_items a')
         prefix = '/search/category'
@@ -61,6 +90,9 @@ class FoodSpider(BaseSpider):
 
         classfies = aa2suffix(classfy_aa)
         areas = aa2suffix(area_aa)
+        # listings of categories, split by `split_region` when needed
+        if self.settings.get('REGION_SPLIT', 'cartesian') == 'adaptive':
+            areas = ['']
 
         def region_requests_generator():
             for c in classfies:
@@ -69,7 +101,7 @@ class FoodSpider(BaseSpider):
                     # /search/category/2/10/g110r2580
                     url = self.add_host(path)
                     request = scrapy.Request(url, self.index, priority=75)
-                    request.meta.update(response.meta)
+                    request.meta['context'] = context
                     yield request
 
         requests = region_requests_generator()
@@ -79,7 +111,13 @@ class FoodSpider(BaseSpider):
 
     # /search/category/2/10/g110r2580
     def index(self, response):
-        d = pq(response.text)
+        d = self.timed('parse', pq, response.text)
+        if (self.settings.get('REGION_SPLIT', 'cartesian') == 'adaptive' and
+                not self.NEXT_PAGE_RE.search(response.url)):
+            requests = self.split_region(response, d)
+            if requests is not None:
+                return requests
+        context = response.meta['context']
         # /search/category/2/10/g110r2580p2
         next_aa = d('.next')
         requests = []
@@ -87,7 +125,7 @@ class FoodSpider(BaseSpider):
         if next_aa:
             url = self.add_host(self.aa2urls(next_aa)[0])
             request = scrapy.Request(url, self.index, priority=50)
-            request.meta.update(response.meta)
+            request.meta['context'] = context
             requests.append(request)
 
         # /shop/75190365
@@ -98,17 +136,106 @@ class FoodSpider(BaseSpider):
             url = self.add_host(url)
             shop_id = url.rsplit('/', 1)[-1]
             request = scrapy.Request(url, self.detail, priority=0)
-            request.meta.update(response.meta)
-            request.meta['shop_id'] = shop_id
+            request.meta['context'] = context.replace(shop_id=shop_id)
             requests.append(request)
 
         requests = self.delta.check_requests(requests, hurry=True)
         self.delta.mark_as_finished(response.request)
         return requests
 
+    # A listing shows at most LISTING_PAGE_LIMIT pages, so the first page of
+    # a listing with more shops returns listings refined by the filters in
+    # its navigation, and an empty listing returns nothing. Returns None if
+    # the listing should be crawled as it is.
+    def split_region(self, response, d):
+        num = d('.search-result .num')
+        if not num:
+            return None
+        count = self.extract_int(num.text())
+        stats = self.crawler.stats
+
+        if count == 0:
+            stats.inc_value('region/pruned')
+            self.delta.mark_as_finished(response.request)
+            return []
+
+        capacity = (self.settings.getint('LISTING_PAGE_LIMIT', 50) *
+                    self.settings.getint('LISTING_PAGE_SIZE', 15))
+        if count is None or count <= capacity:
+            return None
+
+        # refinements add a filter, e.g. g110 -> g110r2580, or replace one
+        # by a sub-category or sub-area, e.g. g110r2580 -> g110r1489. A
+        # navigation which links this listing itself shows its siblings, so
+        # its replacements are not followed, and listings which were
+        # requested before are dropped by the delta check
+        filters = self.listing_filters(response.url)
+        urls = []
+        for nav in ('#classfy a', '#J_nt_items a'):
+            links = [(url, self.listing_filters(url))
+                     for url in map(self.add_host, self.aa2urls(d(nav)))]
+            siblings = any(refined == filters for _, refined in links)
+            for url, refined in links:
+                if not set(refined) >= set(filters) or refined == filters:
+                    continue
+                if siblings and set(refined) == set(filters):
+                    continue
+                if url not in urls:
+                    urls.append(url)
+        if not urls:
+            stats.inc_value('region/capped')
+            self.logger.warning('%s has %s shops, more than %s can be listed',
+                                response.url, count, capacity)
+            return None
+
+        stats.inc_value('region/split')
+        requests = []
+        for url in urls:
+            request = scrapy.Request(url, self.index, priority=75)
+            request.meta['context'] = response.meta['context']
+            requests.append(request)
+        requests = self.delta.check_requests(requests, hurry=True)
+        self.delta.mark_as_finished(response.request)
+        return requests
+
+    @classmethod
+    def listing_filters(cls, url):
+        path = url.rsplit('/', 1)[-1]
+        return {m.group(1): m.group(0) for m in cls.FILTER_RE.finditer(path)}
+
     # /shop/75190365
     def detail(self, response):
-        d = pq(response.text)
+        # already extracted by ParseOffloadMiddleware
+        fields = response.meta.pop('parsed_fields', None)
+        if fields is None:
+            if self.parser_engine == 'lxml':
+                fields = self.timed('extract', extractors.extract_shop, response.text)
+            else:
+                fields = self.extract_shop(response)
+
+        context = response.meta['context']
+
+        item = Shop(
+            _id=context.shop_id,
+            url=response.request.url,
+            name=fields['name'],
+            address=fields['address'],
+            telephones=fields['telephones'],
+            average_price=fields['average_price'],
+            average_score=fields['average_score'],
+            score=fields['score'],
+            meta={
+                'city_id': context.city_id,
+                'city_name': context.city_name,
+                'category_id': self.CATEGORY_ID,
+                'category_url_name': self.name,
+            },
+        )
+        self.delta.mark_as_finished(response.request)
+        return item
+
+    def extract_shop(self, response):
+        d = self.timed('parse', pq, response.text)
         basic_info = d('#basic-info')
         brief_info = basic_info('.brief-info')
 
@@ -138,28 +265,11 @@ class FoodSpider(BaseSpider):
             except ValueError:
                 self.logger.warning('cannot extract float from "%s"', item.text)
 
-        shop_id = response.meta['shop_id']
-        city_id = response.meta['city_id']
-        city_name = response.meta['city_name']
-
-        item = {
-            '_id': shop_id,
-            'url': response.request.url,
+        return {
             'name': shop_name,
             'address': address,
             'telephones': telephones,
-            # 人均
             'average_price': average_price,
-            # 红色方块
             'average_score': average_score,
-            # 满分 10
             'score': score,
-            'meta': {
-                'city_id': city_id,
-                'city_name': city_name,
-                'category_id': self.CATEGORY_ID,
-                'category_url_name': self.name,
-            }
         }
-        self.delta.mark_as_finished(response.request)
-        return item
@@ -1,11 +1,8 @@
 # -*- coding: utf-8 -*-
 import scrapy
 import logging
-import emoji
-import itertools
-import functools
 from pyquery import PyQuery as pq
-from lxml.etree import XMLSyntaxError, ParseError
+from lxml.etree import XMLSyntaxError, ParseError, ParserError
 try:
     from urlparse import urljoin
 except ImportError:
@@ -14,7 +11,12 @@ try:
     import ujson as json
 except ImportError:
     import json
+from . import extractors
+from pymongo import UpdateOne
 from .base_spider import BaseSpider
+from ..context import CrawlContext
+from ..items import Review, TaggedReview
+from ..storage import get_storage
 
 
 class ReviewSpider(BaseSpider):
@@ -35,12 +37,38 @@ class ReviewSpider(BaseSpider):
     logger = logging.getLogger(__name__)
 
     def init(self):
-        super().init(self)
-        self.db_collection = self.delta.db_client[self.name]
-        self.shops = self.delta.db_client['food'].find()
+        super().init()
+        self.storage = get_storage(self.crawler)
+        db = self.delta.db_client[self.delta.db_name]
+        self.db_collection = db[self.name]
+        self.shops = db['food'].find()
+        self.layout = self.settings.get('REVIEW_LAYOUT', 'embedded')
+        if self.layout == 'normalized':
+            self.reviews_collection = db['reviews']
+            self.reviews_collection.create_index('shop_id')
+        elif self.layout != 'embedded':
+            raise ValueError('unknown REVIEW_LAYOUT: {}'.format(self.layout))
+        self.incremental = self.settings.getbool('REVIEW_INCREMENTAL')
+        self.validation = self.settings.getbool('ITEM_VALIDATION')
+
+    # High-water marks of shops, the newest review id crawled of each shop,
+    # which is saved as `newest_review_id` of its document in `review`
+    def load_newest_review_ids(self):
+        cond = {'newest_review_id': {'$exists': True}}
+        return {doc['_id']: doc['newest_review_id']
+                for doc in self.db_collection.find(cond, {'newest_review_id': 1})}
+
+    # incremental runs revisit requests finished by former runs, so they
+    # bypass the delta frontier
+    def check_request(self, request):
+        return request if self.incremental else self.delta.check_request(request)
+
+    def check_requests(self, requests):
+        return list(requests) if self.incremental else self.delta.check_requests(requests)
 
     def start_requests(self):
         self.init()
+        newest_review_ids = self.load_newest_review_ids() if self.incremental else {}
 
         def tags_api_request(shop):
             # for getting tagged_reviews urls
@@ -49,25 +77,31 @@ class ReviewSpider(BaseSpider):
             url = self.add_host(self.TAGS_API_FMT.format(**api_args))
 
             request = scrapy.Request(url, self.parse, priority=100)
-            request.meta['shop_id'] = shop['_id']
+            request.meta['context'] = CrawlContext(api_args['city_id'], api_args['city_name'],
+                                                   shop['_id'])
             request.meta['shop_url'] = shop['url']
+            if shop['_id'] in newest_review_ids:
+                request.meta['newest_review_id'] = newest_review_ids[shop['_id']]
             return request
 
-        return filter(bool, map(tags_api_request, self.shops))
+        shops = (shop for shop in self.shops if self.is_own_partition(shop['_id']))
+        return self.delta.lease_seeds(filter(bool, map(tags_api_request, shops)))
 
     # getting tagged_reviews urls
     def parse(self, response):
         obj = json.loads(response.text.encode('utf8'))
-        shop_id = response.meta['shop_id']
+        context = response.meta['context']
+        shop_id = context.shop_id
         shop_url = response.meta['shop_url']
 
         item = {
             '_id': shop_id,
             'tags': [],
             'recommend_cuisines': obj['dishTagStrList'],
-            'reviews': [],
-            'tagged_reviews': [],
         }
+        if self.layout == 'embedded':
+            item['reviews'] = []
+            item['tagged_reviews'] = []
 
         # tagged_reviews
         if obj['summarys']:
@@ -80,64 +114,127 @@ class ReviewSpider(BaseSpider):
         # all reviews
         url = urljoin(shop_url + '/', 'review_all')
         request = scrapy.Request(url, self.parse_review_all, priority=75)
-        request.meta['shop_id'] = item['_id']
-        request = self.delta.check_request(request)
+        request.meta['context'] = context
+        # carried to the last page for generating tagged reviews requests
+        request.meta['tags'] = [name for name, _ in item['tags']]
+        if 'newest_review_id' in response.meta:
+            request.meta['newest_review_id'] = response.meta['newest_review_id']
+        request = self.check_request(request)
         self.delta.mark_as_finished(response.request)
         return request
 
-    # all reviews about a shop
+    # All reviews about a shop, newest first. In incremental mode, reviews
+    # not newer than `newest_review_id` are known, pagination stops at the
+    # first page of known reviews only, and tagged reviews are skipped if
+    # there is no new review at all.
     def parse_review_all(self, response):
-        d = pq(emoji.demojize(response.text))
-        shop_id = response.meta['shop_id']
-
-        reviews = self.do_parse_reviews(d)
-        self.extend_item_field_in_db(shop_id, 'reviews', reviews)
+        context = response.meta['context']
+        shop_id = context.shop_id
+        # already extracted by ParseOffloadMiddleware
+        page = response.meta.pop('parsed_fields', None)
+        if page is None:
+            page = self.extract_review_page(response)
+        reviews, next_page = page['reviews'], page['next_page']
+
+        newest_review_id = response.meta.get('newest_review_id')
+        if self.incremental and newest_review_id is not None:
+            reviews = [r for r in reviews if r['_id'] > newest_review_id]
+            if not reviews:
+                next_page = None
+        self.save_reviews(shop_id, 'reviews', reviews)
+        # newest review id of this crawl
+        max_review_id = max([r['_id'] for r in reviews] +
+                            [response.meta.get('max_review_id') or 0])
 
         # next page of all reviews
-        next = d('.Pages .NextPage')
-        if next:
-            url = urljoin(response.request.url, next.attr('href'))
+        if next_page:
+            url = urljoin(response.request.url, next_page)
             request = scrapy.Request(url, self.parse_review_all, priority=50)
-            request = self.delta.check_request(request)
+            request.meta['context'] = context
+            request.meta['max_review_id'] = max_review_id
+            for key in ('tags', 'newest_review_id'):
+                if key in response.meta:
+                    request.meta[key] = response.meta[key]
+            request = self.check_request(request)
             self.delta.mark_as_finished(response.request)
-            yield request
+            if request:
+                yield request
         # if all reviews is crawled, then crawl tagged reviews
         else:
-            requests = self.gen_tagged_review_requests(shop_id)
-            requests = self.delta.check_requests(requests)
+            self.save_newest_review_id(shop_id, max_review_id)
+            requests = []
+            if not self.incremental or max_review_id > (newest_review_id or 0):
+                requests = self.gen_tagged_review_requests(context, response.meta.get('tags'),
+                                                           newest_review_id)
+            requests = self.check_requests(requests)
             self.delta.mark_as_finished(response.request)
-            return requests
-
-    def gen_tagged_review_requests(self, shop_id):
-        cursor = self.db_collection.find()
-
-        def gen_tagged_review_request(item):
-            for tag, _ in item['tags']:
-                url = self.add_host(self.TAGGED_API_FMT.format(summary_name=tag,
-                                                               shop_id=shop_id))
-                request = scrapy.Request(url, self.parse_tagged_reviews)
-                request.meta['tag'] = tag
-                request.meta['shop_id'] = shop_id
-                yield request
-
-        list_of_requests = map(gen_tagged_review_request, cursor)
-        requests = functools.reduce(itertools.chain, list_of_requests)
-        return filter(bool, requests)
+            yield from requests
+
+    # costs O(tags of the shop), `tags` is None for requests resumed from
+    # an older delta collection, then fallback to a point query
+    def gen_tagged_review_requests(self, context, tags=None, newest_review_id=None):
+        shop_id = context.shop_id
+        if tags is None:
+            item = self.db_collection.find_one({'_id': shop_id}, {'tags': 1})
+            tags = [tag for tag, _ in item['tags']] if item else []
+
+        for tag in tags:
+            url = self.add_host(self.TAGGED_API_FMT.format(summary_name=tag,
+                                                           shop_id=shop_id))
+            request = scrapy.Request(url, self.parse_tagged_reviews)
+            request.meta['tag'] = tag
+            request.meta['context'] = context
+            if newest_review_id is not None:
+                request.meta['newest_review_id'] = newest_review_id
+            yield request
 
     # tagged reviews
     def parse_tagged_reviews(self, response):
-        html_content = json.loads(emoji.demojize(response.text))['msg']
         tag = response.meta['tag']
-        shop_id = response.meta['shop_id']
+        shop_id = response.meta['context'].shop_id
 
         try:
-            d = pq(html_content)
-            tagged_reviews = self.do_parse_tagged_reviews(d, tag)
-            self.extend_item_field_in_db(shop_id, 'tagged_reviews', tagged_reviews)
+            # already extracted by ParseOffloadMiddleware
+            tagged_reviews = response.meta.pop('parsed_fields', None)
+            if tagged_reviews is None:
+                tagged_reviews = self.extract_tagged_reviews(response, tag)
+            newest_review_id = response.meta.get('newest_review_id')
+            if self.incremental and newest_review_id is not None:
+                tagged_reviews = [r for r in tagged_reviews if r['_id'] > newest_review_id]
+            self.save_reviews(shop_id, 'tagged_reviews', tagged_reviews)
             self.delta.mark_as_finished(response.request)
-        except (XMLSyntaxError, ParseError) as e:
+        except (XMLSyntaxError, ParseError, ParserError) as e:
             self.logger.warn('parse tagged review failed: %s', response.request.url)
 
+    # demojize free text of reviews, or keep the raw text to normalize at
+    # export time, see `DEMOJIZE_REVIEWS`
+    @property
+    def normalize(self):
+        return self.settings.getbool('DEMOJIZE_REVIEWS', True)
+
+    # same as `extractors.parse_review_all`
+    def extract_review_page(self, response):
+        if self.parser_engine == 'lxml':
+            return self.timed('extract', extractors.extract_review_page,
+                              response.body, response.encoding, self.normalize)
+
+        d = self.timed('parse', pq, response.text)
+        next = d('.Pages .NextPage')
+        return {
+            'reviews': self.do_parse_reviews(d),
+            'next_page': next.attr('href') if next else None,
+        }
+
+    # same as `extractors.parse_tagged_reviews`
+    def extract_tagged_reviews(self, response, tag):
+        html_content = json.loads(response.text)['msg']
+        if self.parser_engine == 'lxml':
+            return self.timed('extract', extractors.extract_tagged_reviews,
+                              html_content, tag, 'utf-8', self.normalize)
+
+        d = self.timed('parse', pq, html_content)
+        return self.do_parse_tagged_reviews(d, tag)
+
     def do_parse_tagged_reviews(self, d, tag):
         score_classes = [
             '.sml-str0', '.sml-str10', '.sml-str20',
@@ -168,8 +265,8 @@ class ReviewSpider(BaseSpider):
             date = li('.time').text()
             date = self.text2date(date)
 
-            description = li('.desc').text()
-            tag_sentence = li('.desc span').text()
+            description = extractors.normalize_text(li('.desc').text(), self.normalize)
+            tag_sentence = extractors.normalize_text(li('.desc span').text(), self.normalize)
 
             review = {
                 '_id': id,
@@ -215,6 +312,7 @@ class ReviewSpider(BaseSpider):
                         score[self.WORDS_MAP[w]] = self.extract_int(s)
 
             description = pq(li)('div.content > div.comment-txt > div').text()
+            description = extractors.normalize_text(description, self.normalize)
 
             review = {
                 '_id': id,
@@ -228,20 +326,88 @@ class ReviewSpider(BaseSpider):
 
         return reviews
 
+    # writes are asynchronous and may be reordered, so both of them upsert
     def save_item_to_db(self, item):
-        try:
-            self.db_collection.insert_one(item)
-        except Exception as e:
-            # DEBUG:
-            import ipdb; ipdb.set_trace()
-            raise e
+        cond = {'_id': item['_id']}
+        lists = ('reviews', 'tagged_reviews')
+        update = {'$set': {k: v for k, v in item.items() if k != '_id' and k not in lists}}
+        # lists of the embedded layout
+        if 'reviews' in item:
+            update['$setOnInsert'] = {k: item[k] for k in lists}
+        d = self.storage.call(self.db_collection.update_one, cond, update, upsert=True)
+        d.addErrback(self.storage.log_error, 'save {}'.format(item['_id']))
+
+    # after all pages of reviews are crawled, so an interrupted crawl is
+    # not taken as complete
+    def save_newest_review_id(self, shop_id, review_id):
+        if not review_id:
+            return
+        update = {'$max': {'newest_review_id': review_id}}
+        d = self.storage.call(self.db_collection.update_one, {'_id': shop_id}, update, upsert=True)
+        d.addErrback(self.storage.log_error, 'save newest review id of {}'.format(shop_id))
+
+    # reviews of a page, `field_name` is 'reviews' or 'tagged_reviews'
+    def save_reviews(self, shop_id, field_name, reviews):
+        reviews = self.check_reviews(shop_id, reviews)
+        if not reviews:
+            return
+        if self.layout == 'embedded':
+            self.extend_item_field_in_db(shop_id, field_name, reviews)
+        else:
+            self.upsert_reviews(shop_id, reviews)
+
+    # Reviews are saved by the spider instead of pipelines, so they are
+    # validated here, see `ITEM_VALIDATION`. Return documents of valid
+    # reviews.
+    def check_reviews(self, shop_id, reviews):
+        items = [(TaggedReview if 'tag' in r else Review).from_dict(r) for r in reviews]
+        if self.validation:
+            valid = []
+            stats = self.crawler.stats
+            for item in items:
+                invalid = item.validate()
+                if not invalid:
+                    valid.append(item)
+                    continue
+                stats.inc_value('item/invalid')
+                for name in invalid:
+                    stats.inc_value('item/invalid/{}'.format(name))
+                self.logger.warning('invalid %s of review %s of shop %s',
+                                    ', '.join(invalid), item._id, shop_id)
+            items = valid
+        return [item.to_bson() for item in items]
+
+    # One document per review in the `reviews` collection, a review of
+    # several tags is merged into one document:
+    #
+    #   {'_id': review id, 'shop_id': ..., 'user_id': ..., 'average_score': ...,
+    #    'date': ..., 'score': {...}, 'description': ...,
+    #    'tags': [tag, ...], 'tag_sentences': [{'tag': ..., 'sentence': ...}, ...]}
+    #
+    # fields of review_all pages overwrite those of tagged reviews
+    def upsert_reviews(self, shop_id, reviews):
+        ops = []
+        for review in reviews:
+            fields = {k: v for k, v in review.items()
+                      if k not in ('_id', 'tag', 'tag_sentence')}
+            fields['shop_id'] = shop_id
+            if 'tag' in review:
+                update = {
+                    '$setOnInsert': fields,
+                    '$addToSet': {
+                        'tags': review['tag'],
+                        'tag_sentences': {'tag': review['tag'], 'sentence': review['tag_sentence']},
+                    },
+                }
+            else:
+                update = {'$set': fields}
+            ops.append(UpdateOne({'_id': review['_id']}, update, upsert=True))
+
+        d = self.storage.call(self.reviews_collection.bulk_write, ops, ordered=False)
+        d.addErrback(self.storage.log_error, 'upsert reviews of {}'.format(shop_id))
 
     def extend_item_field_in_db(self, shop_id, field_name, values):
-        try:
-            cond = {'_id': shop_id}
-            update = {'$push': {field_name: {'$each': values}}}
-            self.db_collection.update_one(cond, update)
-        except Exception as e:
-            # DEBUG:
-            import ipdb; ipdb.set_trace()
-            raise e
+        cond = {'_id': shop_id}
+        update = {'$push': {field_name: {'$each': values}}}
+        d = self.storage.call(self.db_collection.update_one, cond, update, upsert=True)
+        d.addErrback(self.storage.log_error, 'extend {} of {}'.format(field_name, shop_id))
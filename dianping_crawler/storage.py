@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Backends to run blocking pymongo calls
+#
+# `sync` runs them in place, `thread` runs them in a dedicated thread pool,
+# so downloading and parsing can overlap with database latency.
+# Both return Deferreds.
+import logging
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+
+class SyncStorage(object):
+    logger = logging.getLogger(__name__)
+
+    def __init__(self):
+        self.running = set()
+
+    def call(self, func, *args, **kwargs):
+        d = self.do_call(func, *args, **kwargs)
+        self.running.add(d)
+
+        def done(result):
+            self.running.discard(d)
+            return result
+
+        return d.addBoth(done)
+
+    def do_call(self, func, *args, **kwargs):
+        return defer.maybeDeferred(func, *args, **kwargs)
+
+    # fired when all running calls are finished
+    def drain(self):
+        return defer.DeferredList(list(self.running))
+
+    def log_error(self, failure, what='mongodb'):
+        self.logger.error('%s failed: %s', what, failure.getErrorMessage())
+
+
+class ThreadStorage(SyncStorage):
+    def __init__(self, pool_size):
+        super().__init__()
+        # not imported at module level, which would install the default
+        # reactor before scrapy installs TWISTED_REACTOR
+        from twisted.internet import reactor
+        self.reactor = reactor
+        self.pool = ThreadPool(1, pool_size, name='mongodb')
+        self.pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+
+    def do_call(self, func, *args, **kwargs):
+        return threads.deferToThreadPool(self.reactor, self.pool, func, *args, **kwargs)
+
+
+# shared by pipelines and spiders of the crawler
+def get_storage(crawler):
+    storage = getattr(crawler, 'mongo_storage', None)
+    if storage is not None:
+        return storage
+
+    backend = crawler.settings.get('STORAGE_BACKEND', 'sync')
+    if backend == 'sync':
+        storage = SyncStorage()
+    elif backend == 'thread':
+        storage = ThreadStorage(crawler.settings.getint('STORAGE_THREADPOOL_SIZE', 10))
+    else:
+        raise ValueError('unknown STORAGE_BACKEND: {}'.format(backend))
+    crawler.mongo_storage = storage
+    return storage